@@ -0,0 +1,45 @@
+/* navigation.js */
+/* Clientside callbacks of red_wire_app.py: tab navigation and validation of the selected period run in the
+   browser, so that only data requests reach the server */
+
+/* Maximum number of days between start and end dates of the selected period */
+const MAX_PERIOD_DAYS = 92;
+
+/* Increment the tab number, except when getting back from the 5th (Result) tab to the 4th (Parameters) tab,
+   as get_next_tab does on the server */
+function getNextTab(activeTab) {
+    const activeTabNumber = parseInt(activeTab.slice(4), 10);
+    if (activeTabNumber === 4) {
+        return "tab-3";
+    }
+    return "tab-" + (activeTabNumber + 1);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    navigation: {
+        home_button: function(n_clicks) {
+            return "tab-0";
+        },
+
+        button_to_next_tab: function(start_clicks, launch_clicks, param_clicks, active_tab) {
+            return getNextTab(active_tab);
+        },
+
+        /* Check the selected period before sending it to the server:
+           returns the period to request (or no_update), the tab to show and the states of the 2 alerts */
+        validate_period: function(n_clicks, start, end, active_tab) {
+            const noUpdate = window.dash_clientside.no_update;
+            // Trigger a warning for blank user input
+            if (!start || !end) {
+                return [noUpdate, noUpdate, !start, !end];
+            }
+            // Trigger a warning for invalid time interval, dates being in YYYY-MM-DD format
+            const days = (Date.parse(end) - Date.parse(start)) / 86400000;
+            if (end < start || days > MAX_PERIOD_DAYS) {
+                return [noUpdate, noUpdate, false, true];
+            }
+            // Clicks are part of the period, so that requesting the same period again triggers the server callback
+            return [{start: start, end: end, clicks: n_clicks}, getNextTab(active_tab), false, false];
+        }
+    }
+});
@@ -0,0 +1,100 @@
+# backfill v0.3
+# Concurrent collection of REE data over a range of dates
+#   Updates from v0.2:
+#   - Checked against the stand-in API server of standin_server.py
+
+'''
+The range of dates to collect is split into windows matching the size of a single API request. Windows are
+fetched concurrently by a bounded pool of threads, while a shared rate limiter spaces out requests sent to the
+API. Raw data from all windows is then merged in time order, so the caller can aggregate it once.
+
+The API URL is a parameter, so the engine can be run against a local server returning REE-shaped JSON:
+'python3 standin_server.py' checks window splitting, rate limiting and merging against such a server.
+'''
+
+# Import librairies
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import time
+import pandas as pd
+import pytz
+
+# Import functions and constants
+from utils import API_request, API_response_to_df, URL
+
+# Time covered by a single API request
+WINDOW = timedelta(days=1)
+# Maximum number of concurrent API requests
+MAX_WORKERS = 4
+# Maximum number of API requests sent per second
+REQUESTS_PER_SECOND = 2
+
+
+def split_windows(begin_date, finish_date, window=WINDOW):
+    '''
+    Input: begin and finish dates of the range to collect, size of a window
+    Output: list of (start, end) dates of the windows covering the range, in Europe/Madrid time
+            as used by the API, each window ending 1 minute before the next one starts
+    '''
+    madrid = pytz.timezone('Europe/Madrid')
+    windows = []
+    start_date = begin_date
+    while start_date < finish_date:
+        end_date = min(start_date + window - timedelta(minutes=1), finish_date)
+        windows.append((start_date.astimezone(madrid), end_date.astimezone(madrid)))
+        start_date += window
+    return windows
+
+
+def make_rate_limiter(requests_per_second):
+    '''
+    Input: maximum number of calls per second
+    Output: function to be called before each request, blocking until the request can be sent
+    '''
+    interval = 1 / requests_per_second
+    lock = threading.Lock()
+    next_time = [time.monotonic()]
+
+    def wait():
+        with lock:
+            now = time.monotonic()
+            send_time = max(now, next_time[0])
+            next_time[0] = send_time + interval
+        time.sleep(max(0, send_time - now))
+
+    return wait
+
+
+def fetch_window(url, window, wait):
+    '''
+    Input: API URL, (start, end) dates of a window, rate limiter function
+    Output: dataframe of raw data returned by the API for this window
+    '''
+    wait()
+    response = API_request(url, window[0], window[1])
+    response.raise_for_status()
+    return API_response_to_df(response)
+
+
+def backfill(begin_date, finish_date, url=URL, window=WINDOW, max_workers=MAX_WORKERS,
+             requests_per_second=REQUESTS_PER_SECOND):
+    '''
+    Input: begin and finish dates of the range to collect, API URL, size of a window,
+           maximum number of concurrent requests, maximum number of requests per second
+    Output: dataframe of raw data for the whole range, sorted by time and without duplicated timestamps
+    '''
+    windows = split_windows(begin_date, finish_date, window)
+    print(f"Collecting {len(windows)} windows with {max_workers} workers...")
+    wait = make_rate_limiter(requests_per_second)
+
+    # executor.map returns results in the order of windows, whatever the order of completion
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(lambda window: fetch_window(url, window, wait), windows))
+
+    if not frames:
+        return pd.DataFrame(columns=['datetime', 'demanda', 'programada', 'prevista', 'datetime_utc'])
+    df = pd.concat(frames, ignore_index=True)
+    # Merge windows in time order, dropping rows returned twice at window boundaries
+    df = df.sort_values('datetime_utc', kind='stable')
+    return df.drop_duplicates(subset='datetime_utc').reset_index(drop=True)
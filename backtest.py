@@ -0,0 +1,192 @@
+# backtest v0.4
+# Rolling-origin backtesting of forecast models over the stored REE history
+#   Updates from v0.3:
+#   - Read predictions from the rows returned by get_batch_prediction
+
+'''
+A model file usable by predict.load_model is replayed over the aggregated data of the binary store (see store.py):
+from each forecast origin, the model predicts the rows 1 to HORIZON steps of the chosen duration after the origin,
+and predictions are compared with the observed 'demanda' values. Origins are spaced by STRIDE steps over the whole
+history, or over a period given with --start and --end.
+
+Each predicted row is given the features of its origin (see predict.add_origin): the time between the origin and
+the row, and the last 'demanda' observed at the origin, so that a model only uses data available when the forecast
+would have been made. Rows are found by timestamp, origin + step * duration, and rows missing from the store are
+skipped. Models using no feature of the origin (see predict.ORIGIN_FEATURES) predict a row the same way from every
+origin: their results per horizon are then errors over the same rows, not forecast errors by lead time.
+
+Origins are split into chunks scored by a pool of processes. The model is loaded through predict.registry before
+the pool is started, so that processes forked from it share the loaded model. Each process loads the data once,
+then predicts all the steps of all the origins of a chunk with a single model call (see
+predict.get_batch_prediction).
+
+Reported for each horizon (steps after the origin):
+    - MAE: mean absolute error in MW
+    - MAPE: mean absolute percentage error, over observed values other than 0
+and the throughput of the model: predictions per second of model calls, and per second of total run time.
+
+Usage: python3 backtest.py <model file> [--duration 1h] [--horizon 24] [--stride 24] [--start 2023-01-01]
+       [--end 2023-12-31] [--workers 4] [--output results.json]
+'''
+
+# Import librairies
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Import functions and constants
+from predict import add_origin, get_batch_prediction, registry
+from store import DURATIONS, STEPS, load_store, slice_range
+from utils import STORE_PATH
+
+# Default number of steps predicted from each origin, and of steps between 2 origins: 1 day
+HORIZON = {'10mn': 144, '1h': 24, '1d': 1}
+STRIDE = HORIZON
+
+# Number of origins scored by a process at a time
+CHUNK_ORIGINS = 256
+
+# Model and data loaded once by each process of the pool
+_worker = {}
+
+
+def _init_worker(model_path, duration, start, end, store_path):
+    records = load_store(duration, store_path)
+    if start is not None:
+        records = slice_range(records, start, end)
+    # Model loaded before the pool was forked, or loaded by this process
+    _worker['model'] = registry.get(model_path)
+    _worker['records'] = np.ascontiguousarray(records)
+
+
+def _score_chunk(origins, horizon, step):
+    '''
+    Input: timestamps of forecast origins in seconds since epoch, number of steps predicted from each origin,
+           seconds of a step
+    Output: dictionary of sums by horizon (absolute errors, absolute percentage errors and their counts),
+            number of predictions and time spent in model calls
+    '''
+    records = _worker['records']
+    timestamps = records['datetime_utc']
+    # Timestamps predicted from each origin, one row per origin and one column per horizon
+    target_times = (origins[:, None] + step * np.arange(1, horizon + 1)).ravel()
+    rows = np.minimum(np.searchsorted(timestamps, target_times), len(records) - 1)
+    found = timestamps[rows] == target_times
+    targets = records[rows[found]]
+    target_origins = np.repeat(origins, horizon)[found]
+
+    call_start = time.perf_counter()
+    prediction = np.full(len(target_times), np.nan)
+    prediction[found] = get_batch_prediction(
+        _worker['model'], add_origin(targets, records, target_origins))['prediction']
+    call_time = time.perf_counter() - call_start
+
+    observed = np.full(len(target_times), np.nan)
+    observed[found] = targets['demanda']
+    errors = np.abs(prediction - observed).reshape(-1, horizon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_errors = (100 * errors.ravel() / np.abs(observed)).reshape(-1, horizon)
+    percentage_errors[~np.isfinite(percentage_errors)] = np.nan
+    return {
+        'abs_error': np.nansum(errors, axis=0),
+        'abs_error_count': np.sum(~np.isnan(errors), axis=0),
+        'pct_error': np.nansum(percentage_errors, axis=0),
+        'pct_error_count': np.sum(~np.isnan(percentage_errors), axis=0),
+        'predictions': int(found.sum()),
+        'call_time': call_time,
+    }
+
+
+def backtest(model_path, duration='1h', horizon=None, stride=None, start=None, end=None, workers=None,
+             store_path=STORE_PATH):
+    '''
+    Input: path and name of the model file, duration of aggregated data, number of steps predicted from each origin,
+           number of steps between 2 origins, start and end dates of the replayed period (whole history if None),
+           number of processes (number of CPUs if None), path of the store
+    Output: dictionary of results: MAE and MAPE per horizon, number of origins and predictions, throughput
+    '''
+    horizon = horizon or HORIZON[duration]
+    stride = stride or STRIDE[duration]
+    step_seconds = STEPS[duration]
+    records = load_store(duration, store_path)
+    if start is not None:
+        records = slice_range(records, start, end)
+    if len(records) == 0:
+        raise ValueError(f"No {duration} rows in the replayed period")
+    # Origins from the first row, leaving a full horizon of time before the last row
+    first, last = int(records['datetime_utc'][0]), int(records['datetime_utc'][-1])
+    origins = np.arange(first, last - horizon * step_seconds + 1, stride * step_seconds, dtype=np.int64)
+    if len(origins) == 0:
+        raise ValueError(f"Not enough {duration} rows for a horizon of {horizon} steps")
+    chunks = [origins[i:i + CHUNK_ORIGINS] for i in range(0, len(origins), CHUNK_ORIGINS)]
+    registry.get(model_path)
+    model_stats = [stats for stats in registry.stats() if stats['path'] == model_path][0]
+
+    run_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_path, duration, start, end, store_path)) as executor:
+        results = list(executor.map(_score_chunk, chunks, [horizon] * len(chunks), [step_seconds] * len(chunks)))
+    run_time = time.perf_counter() - run_start
+
+    def total(key):
+        return sum(result[key] for result in results)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mae = total('abs_error') / total('abs_error_count')
+        mape = total('pct_error') / total('pct_error_count')
+    predictions = total('predictions')
+    call_time = total('call_time')
+    return {
+        'model': model_path,
+        'model_version': model_stats['version'],
+        'model_load_time_s': model_stats['load_time_s'],
+        'model_memory_bytes': model_stats['memory_bytes'],
+        'duration': duration,
+        'period': [str(pd.Timestamp(int(records['datetime_utc'][0]), unit='s')),
+                   str(pd.Timestamp(int(records['datetime_utc'][-1]), unit='s'))],
+        'origins': len(origins),
+        'predictions': int(predictions),
+        'horizons': [
+            {'steps': step, 'minutes': step * STEPS[duration] // 60,
+             'mae': round(float(mae[step - 1]), 3), 'mape': round(float(mape[step - 1]), 3)}
+            for step in range(1, horizon + 1)
+        ],
+        'predictions_per_s_model': round(predictions / call_time, 1) if call_time else None,
+        'predictions_per_s_total': round(predictions / run_time, 1),
+        'run_time_s': round(run_time, 3),
+    }
+
+
+# Backtest a model file given on the command line
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rolling-origin backtesting of a model over the stored REE data")
+    parser.add_argument('model', help="path and name of the model file")
+    parser.add_argument('--duration', choices=DURATIONS, default='1h', help="duration of aggregated data")
+    parser.add_argument('--horizon', type=int, help="number of steps predicted from each origin")
+    parser.add_argument('--stride', type=int, help="number of steps between 2 origins")
+    parser.add_argument('--start', help="start date of the replayed period, YYYY-MM-DD")
+    parser.add_argument('--end', help="end date of the replayed period, YYYY-MM-DD")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument('--store', default=STORE_PATH, help="path of the store")
+    parser.add_argument('--output', help="JSON file to write results to")
+    args = parser.parse_args()
+
+    start = end = None
+    if args.start or args.end:
+        start = (args.start or '1970-01-01') + " 00:00:00"
+        end = (args.end or '2100-12-31') + " 23:59:59"
+    results = backtest(args.model, args.duration, args.horizon, args.stride, start, end, args.workers, args.store)
+
+    print(f"{results['origins']} origins, {results['predictions']} predictions over {results['period']}")
+    print("Horizon    MAE (MW)   MAPE (%)")
+    for row in results['horizons']:
+        print(f"{row['minutes']:>5} mn {row['mae']:>10} {row['mape']:>10}")
+    print("Predictions per second of model calls:", results['predictions_per_s_model'])
+    print("Predictions per second of run time:", results['predictions_per_s_total'])
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,303 @@
+# benchmark v0.7
+# Benchmarks of the hot paths of data collection and of the application, on synthetic REE data
+#   Updates from v0.6:
+#   - Time aggreg_to_utc_duration on raw columns, with the conversion of REE datetimes to UTC, and remove the
+#     temporary working directory at the end of the run
+
+'''
+A synthetic dataset shaped like REE data is generated in a working directory:
+    - 10mn 'demanda', 'programada', 'prevista' values over several years (10 by default), with daily, weekly and
+      yearly seasonality and noise, written to a binary store with its 1h and 1d rollups and a published snapshot
+    - raw JSON API responses, one per day, for the last days of the period, with REE datetimes in Madrid time
+    - an empty user database
+Paths of utils.py are pointed to the working directory before the other modules are imported, so no production
+file is read or written. The working directory is a new temporary directory, removed at the end of the run,
+unless given with --workdir: a given directory must be empty, missing, or created by a previous run (holding a
+MARKER file), as it is emptied first, and is kept after the run.
+
+Timed operations:
+    - decode_API_response on the raw responses, and aggreg_to_utc_duration on their raw columns, REE datetimes
+      being converted to UTC as for data collected by daily_update.py
+    - cached_snapshot on the first request of a process (cold, snapshot mapped) and on later requests (warm)
+    - red_wire_app.get_period_figure, the range query of get_result_callback, for periods of 1 day, 1 month and
+      3 months: on a cache miss (rows sliced and figure update built) and on a cache hit
+    - serialization of the partial figure update to JSON as done by Dash, for the same periods, along with the
+      size of the serialized update
+    - record_connection for known users, written synchronously or queued for the background writer
+
+Each operation is run several times, and its minimum, median, mean and maximum times are stored in a JSON file
+along with the versions of Python and libraries, so that runs can be compared with --compare.
+
+Usage: python3 benchmark.py [--years 10] [--raw-days 30] [--repeat 20] [--workdir /tmp/red-wire-benchmark]
+       [--output results.json] [--compare previous_results.json]
+'''
+
+# Import librairies
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime as dt, timezone
+import numpy as np
+import pandas as pd
+
+# Import the module holding paths, other modules are imported once paths point to the working directory
+import utils
+
+# Default number of years of 10mn data, of days of raw API responses and of runs of each timed operation
+YEARS = 10
+RAW_DAYS = 30
+REPEAT = 20
+
+# Periods selected in the application, in days
+PERIODS = {'1 day': 1, '1 month': 31, '3 months': 92}
+
+# Number of users logging in
+USERS = 20
+
+# File marking a working directory created by the benchmark, which may be emptied by a later run
+MARKER = '.red-wire-benchmark'
+
+# Ratio and difference of median times from which a difference with a previous run is reported as a regression,
+# the difference ignoring noise on operations taking a few microseconds
+REGRESSION_RATIO = 1.2
+REGRESSION_MIN_MS = 0.1
+
+
+def generate_records(years=YEARS, end=None, seed=0):
+    '''
+    Input: number of years of data, end date of the data (last midnight UTC if None), seed of the random generator
+    Output: structured array of 10mn rows using STORE_DTYPE, sorted by timestamp
+    '''
+    from store import STORE_DTYPE
+
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end) if end is not None else pd.Timestamp.now(tz='UTC').tz_localize(None).floor('D')
+    timestamps = np.arange(
+        (end - pd.DateOffset(years=years)).value // 10**9, end.value // 10**9, 600, dtype=np.int64,
+    )
+    hours = (timestamps % 86400) / 3600
+    days = timestamps / 86400
+    weekday = (timestamps // 86400 + 3) % 7
+
+    # Demand in MW: night trough, morning and evening peaks, lower on weekends, higher in winter and summer
+    daily = 3500 * np.sin(np.pi * (hours - 4) / 12) + 1500 * np.sin(2 * np.pi * (hours - 8) / 12)
+    weekly = np.where(weekday >= 5, -3000, 0)
+    yearly = 2000 * np.cos(4 * np.pi * days / 365.25)
+    demanda = 28000 + daily + weekly + yearly + rng.normal(0, 400, len(timestamps))
+
+    records = np.empty(len(timestamps), dtype=STORE_DTYPE)
+    records['datetime_utc'] = timestamps
+    records['demanda'] = demanda
+    records['programada'] = demanda + rng.normal(0, 300, len(timestamps))
+    records['prevista'] = demanda + rng.normal(0, 600, len(timestamps))
+    return records
+
+
+def generate_raw_responses(records, days=RAW_DAYS):
+    '''
+    Input: structured array of 10mn rows, number of days of API responses
+    Output: list of bodies of API responses holding the rows of the last days, one per day, as bytes
+    '''
+    responses = []
+    last_day = records['datetime_utc'][-1] // 86400
+    for day in range(last_day - days + 1, last_day + 1):
+        rows = records[(records['datetime_utc'] >= day * 86400) & (records['datetime_utc'] < (day + 1) * 86400)]
+        responses.append(make_raw_response(rows))
+    return responses
+
+
+def make_raw_response(rows):
+    '''
+    Input: structured array of 10mn rows
+    Output: body of the API response holding these rows, as bytes
+    '''
+    # REE datetimes in Madrid time, e.g. "2024-02-19T03:00:00.000+01:00"
+    local = pd.to_datetime(rows['datetime_utc'], unit='s', utc=True).tz_convert('Europe/Madrid')
+    datetimes = pd.Series(local.strftime('%Y-%m-%dT%H:%M:%S.000%z'))
+    datetimes = (datetimes.str[:-2] + ':' + datetimes.str[-2:]).tolist()
+    included = [
+        {'attributes': {'values': [
+            {'value': round(float(value), 1), 'datetime': datetime}
+            for value, datetime in zip(rows[column], datetimes)
+        ]}}
+        for column in ['demanda', 'programada', 'prevista']
+    ]
+    return json.dumps({'included': included}).encode()
+
+
+def build_dataset(workdir, years=YEARS, raw_days=RAW_DAYS):
+    '''
+    Input: working directory, number of years of data, number of days of API responses
+    Output: list of bodies of API responses; the store and a snapshot are written to the working directory
+    '''
+    from snapshot import publish_snapshot
+    from store import DURATIONS, rollup, write_store
+
+    records = generate_records(years)
+    write_store(records, '10mn', utils.STORE_PATH)
+    for duration in DURATIONS[1:]:
+        write_store(rollup(records, duration), duration, utils.STORE_PATH)
+    publish_snapshot(utils.STORE_PATH)
+    print(f"{len(records)} rows of 10mn data generated in {workdir}")
+    return generate_raw_responses(records, raw_days)
+
+
+def time_function(function, repeat=REPEAT):
+    '''
+    Input: function without arguments, number of runs
+    Output: dictionary of minimum, median, mean and maximum times in milliseconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        'min_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'mean_ms': round(statistics.mean(times), 3),
+        'max_ms': round(max(times), 3),
+        'runs': repeat,
+    }
+
+
+def run_benchmarks(responses, repeat=REPEAT):
+    '''
+    Input: list of bodies of API responses, number of runs of each timed operation
+    Output: dictionary of timing results by operation name
+    '''
+    from plotly.io.json import to_json_plotly
+    from utils import aggreg_to_utc_duration, decode_API_response
+    import red_wire_app as app
+    from connect import record_connection, stop_connection_writer
+    from range_cache import RangeCache
+
+    results = {}
+
+    # Data collection
+    raw_df = pd.concat([decode_API_response(response) for response in responses], ignore_index=True)
+    results['decode_API_response'] = time_function(
+        lambda: [decode_API_response(response) for response in responses], repeat)
+    # Raw columns only: a 'datetime_utc' column decoded beforehand would skip the conversion to UTC
+    raw_df = raw_df[['datetime', 'demanda', 'programada', 'prevista']]
+    for duration in ['10mn', '1h', '1d']:
+        results[f'aggreg_to_utc_duration {duration}'] = time_function(
+            lambda: aggreg_to_utc_duration(raw_df, duration), repeat)
+
+    # Data access, a cold load being timed once per process
+    results['cached_snapshot cold'] = time_function(app.cached_snapshot, 1)
+    results['cached_snapshot warm'] = time_function(app.cached_snapshot, repeat)
+
+    # Range queries of get_result_callback, for periods ending with the data
+    last_day = pd.Timestamp(int(app.cached_snapshot()[1][0]['10mn'][-1]['datetime_utc'][-1]), unit='s').floor('D')
+    # Cache holding nothing, so that every query is a miss
+    no_cache = RangeCache(0)
+    for name, days in PERIODS.items():
+        start_date = str(last_day - pd.Timedelta(days=days - 1))
+        end_date = str(last_day + pd.Timedelta(hours=23, minutes=59, seconds=59))
+        results[f'get_period_figure miss {name}'] = time_function(
+            lambda: app.get_period_figure(start_date, end_date, no_cache), repeat)
+        figure = app.get_period_figure(start_date, end_date)
+        results[f'get_period_figure hit {name}'] = time_function(
+            lambda: app.get_period_figure(start_date, end_date), repeat)
+        results[f'figure to_json {name}'] = time_function(lambda: to_json_plotly(figure), repeat)
+        results[f'figure to_json {name}']['bytes'] = len(to_json_plotly(figure))
+
+    # Login of known users, created by a first login
+    names = [f'user_{user}' for user in range(USERS)]
+    for name in names:
+        record_connection(name)
+    users = iter(names * repeat)
+    results['record_connection'] = time_function(lambda: record_connection(next(users)), repeat)
+    results['record_connection asynchronous'] = time_function(
+        lambda: record_connection(next(users), asynchronous=True), repeat)
+    stop_connection_writer()
+
+    return results
+
+
+def compare_results(results, previous):
+    '''
+    Input: results of this run and of a previous run, as stored in JSON files
+    Output: list of names of operations at least REGRESSION_RATIO times and REGRESSION_MIN_MS slower than in
+            the previous run
+    '''
+    regressions = []
+    for name, timing in results['results'].items():
+        if name not in previous['results']:
+            continue
+        previous_ms = previous['results'][name]['median_ms']
+        ratio = timing['median_ms'] / max(previous_ms, 1e-6)
+        print(f"{name:<45} {previous_ms:>10.3f} -> {timing['median_ms']:>10.3f} ms (x{ratio:.2f})")
+        if ratio >= REGRESSION_RATIO and timing['median_ms'] - previous_ms >= REGRESSION_MIN_MS:
+            regressions.append(name)
+    return regressions
+
+
+# Generate a dataset, run benchmarks and store results
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of Red Wire hot paths on synthetic REE data")
+    parser.add_argument('--years', type=int, default=YEARS, help="number of years of 10mn data")
+    parser.add_argument('--raw-days', type=int, default=RAW_DAYS, help="number of days of raw API responses")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="number of runs of each timed operation")
+    parser.add_argument('--workdir', help="directory of generated data, a new temporary directory if not given")
+    parser.add_argument('--output', help="JSON file to write results to, named after the date if not given")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare results with")
+    args = parser.parse_args()
+
+    # Empty a working directory only if it was created by the benchmark
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='red-wire-benchmark-')
+    else:
+        workdir = os.path.abspath(args.workdir)
+        if os.path.isdir(workdir) and os.listdir(workdir):
+            if not os.path.exists(os.path.join(workdir, MARKER)):
+                sys.exit(f"{workdir} is not empty and was not created by benchmark.py, choose another --workdir")
+            shutil.rmtree(workdir)
+        os.makedirs(workdir, exist_ok=True)
+    open(os.path.join(workdir, MARKER), 'w').close()
+
+    # Point paths to the working directory before importing modules using them as default values
+    workdir = os.path.join(workdir, '')
+    utils.DATA_PATH = workdir
+    utils.STORE_PATH = workdir + 'store/'
+    utils.USER_PATH = workdir
+    utils.MODEL_PATH = workdir + 'Red_Wire_model'
+    os.makedirs(utils.STORE_PATH)
+
+    try:
+        responses = build_dataset(workdir, args.years, args.raw_days)
+        benchmark_results = run_benchmarks(responses, args.repeat)
+    finally:
+        # Temporary working directory created by this run
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results = {
+        'date': dt.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'years': args.years,
+        'raw_days': args.raw_days,
+        'results': benchmark_results,
+    }
+
+    for name, timing in results['results'].items():
+        print(f"{name:<45} median {timing['median_ms']:>10.3f} ms, max {timing['max_ms']:>10.3f} ms")
+    output = args.output or f"benchmark_{dt.now().strftime('%Y%m%dT%H%M%S')}.json"
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print("Results written to", output)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare_results(results, json.load(file))
+        if regressions:
+            print("Regressions:", ', '.join(regressions))
+            sys.exit(1)
@@ -1,25 +1,26 @@
-# catch-up_data v1.2
+# catch-up_data v1.8
 # Script to catch up REE data from the last collect date up to the current date
-# 	Updates from v1.1:
-# 	- Import DATA_PATH constant
-# 	- Record last collect date in a file
+# 	Updates from v1.7:
+# 	- Publish the snapshot and record the collect date even if predictions cannot be computed
 
 '''
 This script catches up REE data from the last collect date up to the current date, if for any reason the data
 collection has been interrupted for a period of time.
 It repeats the treatment of the original daily_update.py script for a range of dates based on the last collect
-date read from the last line in REE_data_aggregated_by_1d.csv.
+date read from last_collect_date.txt: the range is collected by backfill.py, one API request per day with several
+requests at a time, then aggregated once.
 '''
 
 # Import librairies
-from utils import API_request, aggreg_to_utc_duration, moment
-import pandas as pd
-import csv
+from utils import API_stats, moment
+from backfill import backfill
+from ingest import ingest
+from score import score
+from snapshot import publish_snapshot
 from datetime import datetime as dt, timedelta
-import pytz
 
 # Import constants
-from utils import URL, DATA_PATH
+from utils import DATA_PATH
 
 # Open the 1-day aggregated data file aligned with UTC and look for the end of the file to get the last collect start date
 with open(DATA_PATH+'last_collect_date.txt', 'r') as file:
@@ -35,54 +36,28 @@ print("Begins:", begin_date)
 print("Finishes:", finish_date)
 print("Duration:", finish_date-begin_date)
 
-# Loop through the days between the last collect date and yesterday
+# Collect raw data for the whole period, one API request per window, several requests at a time
 print("Start collecting data...")
-collect_date = begin_date.astimezone(pytz.timezone('UTC'))
-while collect_date < finish_date:
-
-    # Set the data collection start and end dates for the current day
-    start_date = collect_date.astimezone(pytz.timezone('Europe/Madrid'))
-    print("\n---------------------------------")
-    print("Start date for data collection:", start_date)
-    end_date = start_date+timedelta(hours=23)+timedelta(minutes=59)
-
-    # # Collect raw data from REE API
-    # response = API_request(URL, start_date, end_date)
-
-    # # Extract values from JSON structure returned in API response
-    # demanda_real = response.json()['included'][0]['attributes']['values']
-    # demanda_programada = response.json()['included'][1]['attributes']['values']
-    # demanda_prevista = response.json()['included'][2]['attributes']['values']
-
-    # # Initialize an empty list which will be converted to a DataFrame in the data aggregation step
-    # df_data = []
-
-    # # Collect raw data and append it to REE_data.csv 
-    # with open(DATA_PATH+'REE_data.csv', 'a', newline='') as file:
-    #     csv_writer = csv.writer(file)
-    #     for real, programada, prevista in zip(demanda_real, demanda_programada, demanda_prevista):
-    #         # Write data to REE_data.csv
-    #         date_time = real['datetime']
-    #         demand = real['value']
-    #         planned = programada['value']
-    #         forecast = prevista['value']
-    #         csv_writer.writerow([date_time, demand, planned, forecast])
-    #         # Append the row to the list which will be converted to a DataFrame in the next step
-    #         df_data.append({'datetime': date_time, 'demanda': demand, 'programada': planned, 'prevista': forecast})
-
-    # # Append REE data to the various aggregated files
-    # for duration in ['10mn', '1h', '1d']:
-    #     df = pd.DataFrame(df_data)
-    #     print(f"Aggregating data by {duration}...")
-    #     print(df.head(3))
-    #     file_path = f'{DATA_PATH}REE_data_aggregated_by_{duration}.csv'
-    #     df_duration = aggreg_to_utc_duration(df, duration)
-    #     print(df_duration.head(1))
-    #     # Append dataframe with reformatted data to destination CSV file
-    #     df_duration.to_csv(file_path, header=False, index=False, mode='a', sep=',')
-    
-    # Increment the collect date by one day to continue the loop
-    collect_date = collect_date+timedelta(days=1)
+df = backfill(begin_date, finish_date)
+print(f"{len(df)} rows collected")
+print("API latency:", API_stats())
+
+# Ingest the whole period at once into REE_data.csv, the aggregated files and the binary store,
+# skipping rows already stored
+print("Ingesting data...")
+written = ingest(df)
+print("Rows written:", written)
+
+# Compute predictions of the model for the new rows, or for all rows if the model file changed
+print("Computing predictions...")
+try:
+    print("Predictions written:", score())
+except Exception as error:
+    # A rejected or failing model must not hold back new data: previous predictions stay in place
+    print("Predictions not computed, previous predictions kept:", repr(error))
+
+# Make new data and its predictions available to the application
+print("Snapshot published:", publish_snapshot())
 
 with open(DATA_PATH+'last_collect_date.txt', 'w') as file:
-    file.write(f"{finish_date}")
\ No newline at end of file
+    file.write(f"{finish_date}")
@@ -1,26 +1,51 @@
-# connect v0.2:
-#   Use constants for path to user database
-#   Move docstring to the top of the file
+# connect v0.7:
+#   Rename the daily count of compact_connections, which shadowed metrics.count
 
 '''
-2 tables used:
+3 tables used:
 - 'USERS':
     - ID
     - Name
+    - Last seen: datetime of the last connection
 - 'CONNECTIONS':
     - ID
     - Datetime
     - User ID
+- 'CONNECTION_COUNTS': number of connections per user and per day, for connections older than RETENTION_DAYS
+    - User ID
+    - Day
+    - Count
+
+USERS.last_seen is updated by a trigger on each insert into CONNECTIONS, so the last connection of a user is read
+from a single row whatever the number of connections recorded.
+Existing databases are upgraded on first use.
+
+The engine is created once per process and its connections are reused between logins.
+SQLite runs in WAL mode, so reads are not blocked by a write from another WSGI thread or process.
+
+In asynchronous mode, record_connection only reads the last connection date: the new connection is queued and
+written by a background thread, in one transaction per batch, so logins do not wait for the SQLite write lock.
+Queued connections are written before the process exits.
+A batch failing to be written is tried again WRITE_RETRIES times, waiting RETRY_DELAY * 2^n seconds before retry n,
+then dropped. Retries and dropped connections are counted in the 'connection_write_retries' and
+'connections_dropped' events of metrics.py, and the number of queued connections is exported as a gauge.
 '''
 
 # Import librairies
-from datetime import datetime
-from sqlalchemy import create_engine, ForeignKey
-from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy.orm import sessionmaker, relationship
+from datetime import datetime, timedelta
+import atexit
+import queue
+import threading
+import time
+from sqlalchemy import create_engine, event, func, inspect, text, ForeignKey, Index
+from sqlalchemy import Column, Integer, String, Date, DateTime
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 
-# Import constants
+# Import functions and constants
+from metrics import count, register_gauges
 from utils import USER_PATH, USER_DB
 
 Base = declarative_base()
@@ -30,6 +55,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True)
+    last_seen = Column(DateTime)
     connections = relationship("Connection", back_populates="user")
 
     def __repr__(self):
@@ -44,16 +70,100 @@ class Connection(Base):
     user_id = Column(Integer, ForeignKey("USERS.id"))
 
     user = relationship("User", back_populates="connections")
+
+    __table_args__ = (Index("ix_connections_user_id_date", "user_id", "date"),)
+
     def __repr__(self):
        return f"Connection({self.user.name} at {self.date})"
 
 
+class ConnectionCount(Base):
+    __tablename__ = "CONNECTION_COUNTS"
+
+    user_id = Column(Integer, ForeignKey("USERS.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, default=0)
+
+    def __repr__(self):
+       return f"ConnectionCount({self.user_id} on {self.day}: {self.count})"
+
+
+# Number of connections kept in the pool, and additional connections opened under load
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+# Number of days connections are kept in CONNECTIONS before being compacted into CONNECTION_COUNTS
+RETENTION_DAYS = 90
+
+# Maximum number of connections written in one transaction, and seconds waited for more connections to queue
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.5
+
+# Number of retries of a batch failing to be written, and seconds waited before the first retry
+WRITE_RETRIES = 3
+RETRY_DELAY = 0.5
+
+# Trigger keeping USERS.last_seen up to date
+LAST_SEEN_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS update_last_seen AFTER INSERT ON CONNECTIONS
+BEGIN
+    UPDATE USERS SET last_seen = NEW.date
+    WHERE id = NEW.user_id AND (last_seen IS NULL OR last_seen < NEW.date);
+END
+'''
+
+# Engine shared by all sessions of the process
+engine = create_engine(
+    f"sqlite:///{USER_PATH+USER_DB}",
+    echo=False,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    # Connections are shared between WSGI threads, wait up to 30 s for a write lock
+    connect_args={'check_same_thread': False, 'timeout': 30},
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# Session factory giving each thread its own session
+Session = scoped_session(sessionmaker(bind=engine))
+
+# Tables are created once per process, on first use
+schema_lock = threading.Lock()
+schema_created = False
+
+
+def create_schema():
+    global schema_created
+    with schema_lock:
+        if not schema_created:
+            Base.metadata.create_all(engine)
+            upgrade_schema()
+            schema_created = True
+
+
+def upgrade_schema():
+    # Upgrade a database created by a previous version: tables already exist, so create_all added nothing to them
+    with engine.begin() as connection:
+        if 'last_seen' not in [column['name'] for column in inspect(connection).get_columns('USERS')]:
+            connection.execute(text("ALTER TABLE USERS ADD COLUMN last_seen DATETIME"))
+            connection.execute(text(
+                "UPDATE USERS SET last_seen = (SELECT max(date) FROM CONNECTIONS WHERE user_id = USERS.id)"
+            ))
+        for index in Connection.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        connection.execute(text(LAST_SEEN_TRIGGER))
+
+
 def create_session():
-    engine = create_engine(f"sqlite:///{USER_PATH+USER_DB}", echo=False)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
+    create_schema()
+    return Session()
 
 
 def get_user_or_create_it(session, user_name):
@@ -91,16 +201,197 @@ def register_new_connection(session, user_name):
 
 
 def get_last_connection_date(session, user_name):
-    last_connection = (
+    return (
         session
-        .query(Connection)
-        .join(User)
+        .query(User.last_seen)
         .filter(User.name == user_name)
-        .order_by(Connection.date.desc())
-        .first()
+        .scalar()
     )
 
-    if last_connection is None:
-        return None
-    else:
-        return last_connection.date
+
+def record_connection(user_name, asynchronous=False):
+    """Register a new connection of a user, creating the user if needed,
+    and get the date of the user's previous connection, in a single transaction.
+
+    Args:
+        user_name (str)
+        asynchronous (bool): queue the new connection for the background writer
+            instead of writing it before returning
+
+    Returns:
+        datetime: date of the previous connection, None for a new user.
+    """
+    if asynchronous:
+        start_connection_writer()
+        date = datetime.today()
+        session = create_session()
+        try:
+            last_date = get_last_connection_date(session, user_name)
+        finally:
+            Session.remove()
+        connection_queue.put((user_name, date))
+        return last_date
+
+    session = create_session()
+    try:
+        # A concurrent first login of the same user may create it first: try again once
+        for attempt in range(2):
+            try:
+                user_id, last_date = (
+                    session
+                    .query(User.id, User.last_seen)
+                    .filter(User.name == user_name)
+                    .first()
+                ) or (None, None)
+                if user_id is None:
+                    connection = Connection(date=datetime.today(), user=User(name=user_name))
+                else:
+                    connection = Connection(date=datetime.today(), user_id=user_id)
+                session.add(connection)
+                session.commit()
+                return last_date
+            except IntegrityError:
+                session.rollback()
+                if attempt:
+                    raise
+    finally:
+        Session.remove()
+
+
+# Connections waiting to be written by the background writer, None asking the writer to stop
+connection_queue = queue.Queue()
+writer_lock = threading.Lock()
+writer_thread = None
+register_gauges(lambda: {'connection_queue_size': connection_queue.qsize()})
+
+
+def write_connections(connections):
+    """Write connections in a single transaction, creating users if needed.
+
+    Args:
+        connections: list of (user name, datetime) tuples
+    """
+    session = create_session()
+    try:
+        # A concurrent first login of the same user may create it first: try again once
+        for attempt in range(2):
+            try:
+                names = {name for name, _ in connections}
+                user_ids = dict(session.query(User.name, User.id).filter(User.name.in_(names)).all())
+                for name in names - user_ids.keys():
+                    user = User(name=name)
+                    session.add(user)
+                    session.flush()
+                    user_ids[name] = user.id
+                session.execute(
+                    insert(Connection),
+                    [{'user_id': user_ids[name], 'date': date} for name, date in connections],
+                )
+                session.commit()
+                return
+            except IntegrityError:
+                session.rollback()
+                if attempt:
+                    raise
+    finally:
+        Session.remove()
+
+
+def write_queued_connections():
+    # Loop of the background writer: wait for a connection, gather the ones queued meanwhile and write them
+    while True:
+        items = [connection_queue.get()]
+        while items[-1] is not None and len(items) < BATCH_SIZE:
+            try:
+                items.append(connection_queue.get(timeout=FLUSH_INTERVAL))
+            except queue.Empty:
+                break
+        connections = [item for item in items if item is not None]
+        if connections:
+            write_batch(connections)
+        if items[-1] is None:
+            return
+
+
+def write_batch(connections, retries=WRITE_RETRIES, delay=RETRY_DELAY):
+    """Write a batch of connections, trying again with exponential backoff on failure.
+
+    Args:
+        connections: list of (user name, datetime) tuples
+        retries (int): number of retries before the batch is dropped
+        delay (float): seconds waited before the first retry, doubled at each retry
+
+    Returns:
+        bool: True if the batch was written, False if it was dropped.
+    """
+    for attempt in range(retries + 1):
+        try:
+            write_connections(connections)
+            return True
+        except Exception as error:
+            if attempt == retries:
+                count('connections_dropped', len(connections))
+                print("Dropped", len(connections), "connections after", retries, "retries:", error)
+                return False
+            count('connection_write_retries')
+            time.sleep(delay * 2 ** attempt)
+
+
+def start_connection_writer():
+    # Start the background writer of the current process, unless already running
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None or not writer_thread.is_alive():
+            writer_thread = threading.Thread(target=write_queued_connections, name='connection-writer', daemon=True)
+            writer_thread.start()
+
+
+@atexit.register
+def stop_connection_writer():
+    """Write the queued connections and stop the background writer."""
+    global writer_thread
+    with writer_lock:
+        if writer_thread is not None and writer_thread.is_alive():
+            connection_queue.put(None)
+            writer_thread.join()
+        writer_thread = None
+
+
+def compact_connections(retention_days=RETENTION_DAYS):
+    """Replace connections older than retention_days with their number per user and per day.
+
+    Args:
+        retention_days (int)
+
+    Returns:
+        int: number of connections compacted.
+    """
+    cutoff = datetime.combine(datetime.today().date() - timedelta(days=retention_days), datetime.min.time())
+    session = create_session()
+    try:
+        day = func.date(Connection.date)
+        daily_counts = (
+            session
+            .query(Connection.user_id, day, func.count())
+            .filter(Connection.date < cutoff)
+            .group_by(Connection.user_id, day)
+            .all()
+        )
+        for user_id, connection_day, connections in daily_counts:
+            statement = insert(ConnectionCount).values(
+                user_id=user_id, day=datetime.strptime(connection_day, '%Y-%m-%d').date(), count=connections,
+            )
+            session.execute(statement.on_conflict_do_update(
+                index_elements=['user_id', 'day'],
+                set_={'count': ConnectionCount.count + statement.excluded.count},
+            ))
+        compacted = session.query(Connection).filter(Connection.date < cutoff).delete(synchronize_session=False)
+        session.commit()
+        return compacted
+    finally:
+        Session.remove()
+
+
+# Retention job, to be run periodically, e.g. along with daily_update.py
+if __name__ == '__main__':
+    print("Connections compacted:", compact_connections())
@@ -1,13 +1,12 @@
-# daily_update v1.1
-#   Updates from v1.0:
-#   - Update comments
-#   - Add imports
-#   - Add managing time lag
+# daily_update v1.8
+#   Updates from v1.7:
+#   - Publish the snapshot even if predictions cannot be computed
 
 # Import librairies
-from utils import API_request, aggreg_to_utc_duration, moment
-import pandas as pd
-import csv
+from utils import API_request, API_response_to_df, API_stats, moment
+from ingest import ingest
+from score import score
+from snapshot import publish_snapshot
 from datetime import datetime as dt
 import pytz
 
@@ -23,35 +22,27 @@ print(end_date)
 
 # Collect raw data from REE API
 response = API_request(URL, start_date, end_date)
-
-# Extract values from JSON structure returned in API response
-demanda_real = response.json()['included'][0]['attributes']['values']
-demanda_programada = response.json()['included'][1]['attributes']['values']
-demanda_prevista = response.json()['included'][2]['attributes']['values']
-
-# Initialize an empty list to help the aggregation process
-df_data = []
-
-# Append new data to REE_data.csv collecting raw data
-with open('data/REE_data.csv', 'a', newline='') as file:
-    csv_writer = csv.writer(file)
-    for real, programada, prevista in zip(demanda_real, demanda_programada, demanda_prevista):
-        # Write data to REE_data.csv
-        date_time = real['datetime']
-        demand = real['value']
-        planned = programada['value']
-        forecast = prevista['value']
-        csv_writer.writerow([date_time, demand, planned, forecast])
-        # Append the row to the DataFrame
-        df_data.append({'datetime': date_time, 'demanda': demand, 'programada': planned, 'prevista': forecast})
-
-# Append REE data to the various aggregated files
-for duration in ['10mn', '1h', '1d']:
-    df = pd.DataFrame(df_data)
-    print(df.head())
-    print(f"Aggregating data by {duration}...")
-    file_path = f'data/REE_data_aggregated_by_{duration}.csv'
-    df_duration = aggreg_to_utc_duration(df, duration)
-    print(df_duration.head())
-    # Append dataframe with reformatted data to destination CSV file
-    df_duration.to_csv(file_path, header=False, index=False, mode='a', sep=',')
\ No newline at end of file
+# Error response left once retries are exhausted
+response.raise_for_status()
+
+print("API latency:", API_stats())
+
+# Extract raw data from JSON structure returned in API response
+df = API_response_to_df(response)
+print(df.head())
+
+# Ingest new data into REE_data.csv, the aggregated files and the binary store, skipping rows already stored
+print("Ingesting data...")
+written = ingest(df)
+print("Rows written:", written)
+
+# Compute predictions of the model for the new rows, or for all rows if the model file changed
+print("Computing predictions...")
+try:
+    print("Predictions written:", score())
+except Exception as error:
+    # A rejected or failing model must not hold back new data: previous predictions stay in place
+    print("Predictions not computed, previous predictions kept:", repr(error))
+
+# Make new data and its predictions available to the application
+print("Snapshot published:", publish_snapshot())
@@ -0,0 +1,210 @@
+# ingest v0.5
+# Idempotent incremental ingest of raw REE data
+#   Updates from v0.4:
+#   - Leave publishing the snapshot to the end of the daily pipeline, after predictions are computed
+
+'''
+Raw REE data collected by daily_update.py or catch-up_data.py is ingested into:
+- REE_data.csv: raw data
+- REE_data_aggregated_by_10mn.csv and the 10mn store: raw data aggregated by 10 mn
+- REE_data_aggregated_by_1h.csv / _1d.csv and the 1h / 1d stores: rollups of the 10mn data
+
+Each destination is keyed on its timestamps: new rows are merged with stored rows, a row replacing the stored
+row with the same timestamp. Running an ingest twice, or after a partial failure, therefore never duplicates rows,
+and rows older than the last stored row (a backfilled gap) are inserted in time order. The last 1h or 1d row,
+computed from a partial day when a collect period does not match UTC days, gets completed by the next ingest.
+
+Only new data is processed: 1h and 1d rollups are recomputed from the 10mn rows of the steps touched by the new
+rows, and CSV files are only read and rewritten from the first new row.
+The new end of a CSV file is written to a temporary file, renamed to <file>.tail once complete, then copied over
+the end of the file. If the copy is interrupted, the next ingest completes it from <file>.tail before reading the
+file, so a crash never leaves a truncated CSV file.
+The updated store is published for the application once predictions are computed for the new rows: ingest, then
+score.py, then snapshot.publish_snapshot, as run by daily_update.py and catch-up_data.py.
+'''
+
+# Import librairies
+import os
+import numpy as np
+import pandas as pd
+
+# Import functions and constants
+from store import DURATIONS, STEPS, frame_to_records, read_range, records_to_frame, rollup, to_epoch, upsert_store
+from utils import aggreg_to_utc_duration, ree_datetimes_to_utc, DATA_PATH, STORE_PATH
+
+# Columns of REE_data.csv
+RAW_COLUMNS = ['datetime', 'demanda', 'programada', 'prevista']
+
+# Size of blocks read from the end of CSV files
+TAIL_BLOCK = 64 * 1024
+
+
+def _lines_from_end(file):
+    '''
+    Input: file opened in binary mode
+    Output: generator of (offset, line) for the complete lines of the file, from the last one to the first one
+
+    A last line without line ending, left by an interrupted write, is not complete and not returned.
+    '''
+    position = file.seek(0, os.SEEK_END)
+    stop = position
+    buffer = b''
+    found_stop = False
+    while True:
+        # Prepend the previous block of the file to the buffer, which holds file[position:stop]
+        if position > 0:
+            read_from = max(0, position - TAIL_BLOCK)
+            file.seek(read_from)
+            buffer = file.read(position - read_from) + buffer
+            position = read_from
+        # Complete lines end at the last line ending of the file
+        if not found_stop:
+            last_newline = buffer.rfind(b'\n')
+            if last_newline < 0 and position > 0:
+                continue
+            stop = position + last_newline + 1
+            buffer = buffer[:last_newline + 1]
+            found_stop = True
+        lines = buffer.split(b'\n')[:-1]
+        # The first line of the buffer may start in the previous block
+        complete_lines = lines if position == 0 else lines[1:]
+        for line in reversed(complete_lines):
+            stop -= len(line) + 1
+            yield stop, line
+        if position == 0:
+            return
+        buffer = buffer[:stop - position]
+
+
+def _first_field(line):
+    # First field of a CSV line, holding the timestamp
+    return line.decode().split(',')[0]
+
+
+def _tail_lines(file, cutoff, parse_timestamp):
+    # Offset of the first complete line with a timestamp >= cutoff (the end of the complete lines if none),
+    # and list of (timestamp, line) of the lines from this offset, in file order
+    offset = None
+    lines = []
+    for start, line in _lines_from_end(file):
+        if offset is None:
+            offset = start + len(line) + 1
+        try:
+            timestamp = parse_timestamp(_first_field(line))
+        except ValueError:
+            # Header line
+            break
+        if timestamp < cutoff:
+            break
+        offset = start
+        lines.append((timestamp, line + b'\n'))
+    return (0 if offset is None else offset), lines[::-1]
+
+
+def _write_atomic(file_path, content):
+    # Write content to a temporary file renamed to file_path once complete
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def _apply_tail(file_path):
+    # Copy the pending end of a CSV file, written to <file>.tail, over the end of the file
+    tail_path = file_path + '.tail'
+    if not os.path.exists(tail_path):
+        return
+    with open(tail_path, 'rb') as tail:
+        offset = int(tail.readline())
+        content = tail.read()
+    with open(file_path, 'rb+') as file:
+        file.truncate(offset)
+        file.seek(0, os.SEEK_END)
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.remove(tail_path)
+
+
+def upsert_csv(file_path, df, timestamps, parse_timestamp):
+    '''
+    Input: path of a CSV file, dataframe of rows sorted by time, their timestamps in seconds since epoch,
+           function parsing the first field of a line of the file to seconds since epoch
+    Output: number of rows written
+
+    Rows are merged with the lines of the file from the first row onwards: a row replaces the line with the same
+    timestamp, and rows older than the last line are inserted in time order. Only the end of the file from the
+    first row is read and rewritten, through <file>.tail.
+    '''
+    # Complete an end of file left by an interrupted ingest
+    _apply_tail(file_path)
+    if len(df) == 0:
+        return 0
+    if not os.path.exists(file_path):
+        _write_atomic(file_path, df.to_csv(index=False, sep=',').encode())
+        return len(df)
+
+    new_lines = df.to_csv(header=False, index=False, sep=',').encode().splitlines(keepends=True)
+    with open(file_path, 'rb') as file:
+        offset, stored_lines = _tail_lines(file, timestamps[0], parse_timestamp)
+    merged = dict(stored_lines)
+    merged.update(zip(timestamps.tolist(), new_lines))
+    content = b''.join(merged[timestamp] for timestamp in sorted(merged))
+
+    # The end of the file is complete on disk before the file is modified
+    _write_atomic(file_path + '.tail', str(offset).encode() + b'\n' + content)
+    _apply_tail(file_path)
+    return len(df)
+
+
+def _parse_ree_timestamp(value):
+    # Raw REE datetime, e.g. "2024-02-19T03:00:00.000+01:00", to seconds since epoch
+    return int(to_epoch(ree_datetimes_to_utc([value]))[0])
+
+
+def _parse_utc_timestamp(value):
+    # Aggregated UTC datetime, e.g. "2024-02-19 02:00:00", to seconds since epoch
+    return int(to_epoch([value])[0])
+
+
+def ingest(df, data_path=DATA_PATH, store_path=STORE_PATH):
+    '''
+    Input: dataframe of raw data with 'datetime' in REE format and 'demanda', 'programada', 'prevista' values,
+           and optionally 'datetime_utc' as returned by decode_API_response
+    Output: dictionary with the number of rows written to each destination
+    '''
+    written = {}
+    if len(df) == 0:
+        return written
+
+    # Raw data, sorted by UTC time
+    if 'datetime_utc' not in df:
+        df = df.assign(datetime_utc=ree_datetimes_to_utc(df['datetime']))
+    raw_timestamps = df['datetime_utc'].values.astype('datetime64[s]').astype(np.int64)
+    order = np.argsort(raw_timestamps, kind='stable')
+    df, raw_timestamps = df.iloc[order], raw_timestamps[order]
+    written['raw'] = upsert_csv(data_path + 'REE_data.csv', df[RAW_COLUMNS], raw_timestamps, _parse_ree_timestamp)
+
+    # 10mn data aggregated from raw data
+    records = frame_to_records(aggreg_to_utc_duration(df, '10mn'))
+    upsert_store(records, '10mn', store_path)
+    written['10mn'] = upsert_csv(
+        f'{data_path}REE_data_aggregated_by_10mn.csv', records_to_frame(records), records['datetime_utc'],
+        _parse_utc_timestamp,
+    )
+
+    # Coarser durations rolled up from the stored 10mn rows of the steps touched by new rows
+    last_10mn = pd.Timestamp(int(records['datetime_utc'][-1]), unit='s')
+    for duration in DURATIONS[1:]:
+        first_step = pd.Timestamp(int(records['datetime_utc'][0] // STEPS[duration] * STEPS[duration]), unit='s')
+        touched = read_range('10mn', first_step, last_10mn, store_path)
+        rolled_up = rollup(touched, duration)
+        upsert_store(rolled_up, duration, store_path)
+        written[duration] = upsert_csv(
+            f'{data_path}REE_data_aggregated_by_{duration}.csv', records_to_frame(rolled_up),
+            rolled_up['datetime_utc'], _parse_utc_timestamp,
+        )
+
+    return written
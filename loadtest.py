@@ -0,0 +1,298 @@
+# loadtest v0.5
+# Load test of the Dash callbacks of the application by concurrent simulated users
+#   Updates from v0.4:
+#   - Remove the temporary working directory when the run ends
+
+'''
+Simulated users replay the requests sent by the browser to the Dash server ('_dash-update-component' POSTs):
+    - login with a user name, handled by enter_id_callback
+    - range queries over random periods of 1 to 92 days, handled by get_result_callback once validated by the
+      browser (tab navigation and validation run in the browser and send no request)
+Payloads are built from the callback dependencies served by the application ('_dash-dependencies'), so they match
+the ids generated by dash_extensions for callbacks sharing outputs.
+
+Requests are sent either in-process, with the Flask test client of red_wire_app.server (default, no network and no
+web server needed), or over HTTP to a running deployment given with --url, e.g. http://127.0.0.1:8050.
+Each user is a thread logging in then sending range queries until the end of the run. Runs are repeated for each
+number of concurrent users given with --users, so the number of users from which latency degrades can be read
+from the report: throughput, latency percentiles per callback, errors, and memory (RSS) of the process serving
+requests in-process, or of the worker processes given with --pids.
+
+Requests sent in-process are served with the paths of utils.py pointed to a working directory, so that production
+data and user database are left untouched: the one given with --workdir, holding synthetic data generated by
+benchmark.py when --years is given, or a new temporary directory holding --years (benchmark.YEARS by default) of
+synthetic data, removed when the run ends. Paths are left unchanged when requests are sent to a deployment with
+--url.
+
+Usage: python3 loadtest.py [--users 1,2,4,8,16] [--seconds 20] [--url http://127.0.0.1:8050] [--pids 1234,1235]
+       [--workdir /tmp/red-wire-loadtest --years 10] [--output results.json]
+'''
+
+# Import librairies
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Import the module holding paths, other modules are imported once paths may point to a working directory
+import utils
+
+# Default numbers of concurrent users, and duration of a run for each of them in seconds
+USERS = [1, 2, 4, 8, 16]
+SECONDS = 20
+
+# Range of period lengths queried by users, in days, as allowed by get_result_callback
+MIN_DAYS, MAX_DAYS = 1, 92
+
+# Percentiles of latencies reported
+PERCENTILES = [50, 90, 95, 99]
+
+
+def output_spec(output):
+    # Outputs of a callback as sent by the browser, from the output string of '_dash-dependencies':
+    # 'id.property' for a single output, '..id1.property1...id2.property2..' for several outputs
+    if not output.startswith('..'):
+        component_id, component_property = output.split('.', 1)
+        return {'id': component_id, 'property': component_property}
+    return [output_spec(part) for part in output[2:-2].split('...')]
+
+
+def find_dependency(dependencies, input_id):
+    '''
+    Input: list of callback dependencies served by '_dash-dependencies', 'id.property' of the triggering input
+    Output: dependency of the callback triggered by this input
+    '''
+    for dependency in dependencies:
+        if any(f"{item['id']}.{item['property']}" == input_id for item in dependency['inputs']):
+            return dependency
+    raise ValueError(f"No callback triggered by {input_id}")
+
+
+def build_payload(dependency, inputs, state):
+    '''
+    Input: callback dependency, dictionaries of values of inputs and states by 'id.property'
+    Output: body of the '_dash-update-component' request triggering the callback with these values
+    '''
+    def values(items, given):
+        return [
+            {'id': item['id'], 'property': item['property'], 'value': given.get(f"{item['id']}.{item['property']}")}
+            for item in items
+        ]
+    return {
+        'output': dependency['output'],
+        'outputs': output_spec(dependency['output']),
+        'inputs': values(dependency['inputs'], inputs),
+        'state': values(dependency['state'], state),
+        'changedPropIds': list(inputs),
+    }
+
+
+class InProcessClient:
+    '''
+    Client sending requests to the Flask server of the application in this process.
+    '''
+
+    def __init__(self, server):
+        self.client = server.test_client()
+
+    def get_json(self, path):
+        return self.client.get(path).get_json()
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, len(response.data)
+
+
+class HTTPClient:
+    '''
+    Client sending requests to a running deployment of the application.
+    '''
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def get_json(self, path):
+        return self.session.get(self.url + path, timeout=60).json()
+
+    def post(self, path, payload):
+        response = self.session.post(self.url + path, json=payload, timeout=60)
+        return response.status_code, len(response.content)
+
+
+def rss_mb(pid='self'):
+    '''
+    Input: process id, the current process by default
+    Output: resident memory of the process in MB, None if unknown
+    '''
+    try:
+        with open(f'/proc/{pid}/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def simulate_user(user, make_client, dependencies, period, stop_time, latencies, errors):
+    '''
+    Input: user number, function creating a client, callback dependencies, (first, last) days of queried periods,
+           time.monotonic() value at which to stop, dictionaries of latency lists and error status lists by callback
+    Output: None, latencies of requests are appended to latencies, status codes of failed requests to errors
+    '''
+    client = make_client()
+    rng = random.Random(user)
+    login = find_dependency(dependencies, 'connect-button.n_clicks')
+    query = find_dependency(dependencies, 'valid-period.data')
+    first_day, last_day = period
+
+    def send(name, payload):
+        start = time.perf_counter()
+        status, _ = client.post('/_dash-update-component', payload)
+        latencies[name].append(1000 * (time.perf_counter() - start))
+        if status not in (200, 204):
+            errors[name].append(status)
+
+    send('enter_id_callback', build_payload(
+        login, {'connect-button.n_clicks': 1}, {'name-box.value': f'loadtest_{user}', 'tabs.active_tab': 'tab-2'},
+    ))
+    clicks = 0
+    while time.monotonic() < stop_time:
+        clicks += 1
+        days = rng.randint(MIN_DAYS, MAX_DAYS)
+        start_day = first_day + pd.Timedelta(days=rng.randint(0, max((last_day - first_day).days - days, 0)))
+        end_day = start_day + pd.Timedelta(days=days - 1)
+        period = {'start': start_day.strftime('%Y-%m-%d'), 'end': end_day.strftime('%Y-%m-%d'), 'clicks': clicks}
+        send('get_result_callback', build_payload(query, {'valid-period.data': period}, {}))
+
+
+def run_load(users, seconds, make_client, period, pids=None):
+    '''
+    Input: number of concurrent users, duration of the run in seconds, function creating a client,
+           (first, last) days of queried periods, process ids of the workers serving requests over HTTP
+    Output: dictionary of results: throughput, latency percentiles and errors by callback, memory by process
+    '''
+    dependencies = make_client().get_json('/_dash-dependencies')
+    names = ['enter_id_callback', 'get_result_callback']
+    latencies = {name: [] for name in names}
+    errors = {name: [] for name in names}
+
+    start = time.perf_counter()
+    stop_time = time.monotonic() + seconds
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        futures = [
+            executor.submit(simulate_user, user, make_client, dependencies, period, stop_time, latencies, errors)
+            for user in range(users)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    requests_sent = sum(len(values) for values in latencies.values())
+    results = {
+        'users': users,
+        'seconds': round(elapsed, 2),
+        'requests': requests_sent,
+        'requests_per_s': round(requests_sent / elapsed, 1),
+        'callbacks': {},
+        'memory_mb': {str(pid): rss_mb(pid) for pid in (pids or ['self'])},
+    }
+    for name in names:
+        values = np.array(latencies[name])
+        if len(values) == 0:
+            continue
+        results['callbacks'][name] = {
+            'requests': len(values),
+            'errors': len(errors[name]),
+            'mean_ms': round(float(values.mean()), 1),
+            **{f'p{percentile}_ms': round(float(np.percentile(values, percentile)), 1)
+               for percentile in PERCENTILES},
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{results['users']:>3} users: {results['requests_per_s']:>7} requests/s, memory (MB): "
+          f"{results['memory_mb']}")
+    for name, stats in results['callbacks'].items():
+        percentiles = ', '.join(f"p{percentile} {stats[f'p{percentile}_ms']} ms" for percentile in PERCENTILES)
+        print(f"      {name:<22} {stats['requests']:>6} requests, {stats['errors']} errors, {percentiles}")
+
+
+# Run the load test for each number of concurrent users
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the Red Wire Dash callbacks")
+    parser.add_argument('--users', default=','.join(map(str, USERS)), help="numbers of concurrent users")
+    parser.add_argument('--seconds', type=float, default=SECONDS, help="duration of a run")
+    parser.add_argument('--url', help="URL of a running deployment, requests are sent in-process if not given")
+    parser.add_argument('--pids', help="process ids of the workers of the deployment, to report their memory")
+    parser.add_argument('--start', help="first day of queried periods, YYYY-MM-DD, first stored day by default")
+    parser.add_argument('--end', help="last day of queried periods, YYYY-MM-DD, last stored day by default")
+    parser.add_argument('--workdir', help="directory replacing the data and user database directories in-process, "
+                                          "a new temporary directory if not given")
+    parser.add_argument('--years', type=int, help="generate this number of years of synthetic data in --workdir")
+    parser.add_argument('--output', help="JSON file to write results to")
+    args = parser.parse_args()
+
+    # Requests sent in-process never use the production user database, users being created by logins
+    workdir, years = args.workdir, args.years
+    if workdir is None and args.url is None:
+        from benchmark import YEARS
+        workdir = tempfile.mkdtemp(prefix='red-wire-loadtest-')
+        years = years or YEARS
+        # Removed when the process exits, after the handlers registered later, e.g. by the connection writer
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+
+    # Point paths to the working directory before importing modules using them as default values
+    if workdir:
+        workdir = os.path.join(os.path.abspath(workdir), '')
+        utils.DATA_PATH = workdir
+        utils.STORE_PATH = workdir + 'store/'
+        utils.USER_PATH = workdir
+        utils.MODEL_PATH = workdir + 'Red_Wire_model'
+        os.makedirs(utils.STORE_PATH, exist_ok=True)
+        if years:
+            from benchmark import build_dataset
+            build_dataset(workdir, years, 1)
+
+    if args.url:
+        def make_client():
+            return HTTPClient(args.url)
+        pids = [int(pid) for pid in args.pids.split(',')] if args.pids else None
+    else:
+        import red_wire_app
+        server = red_wire_app.server
+
+        def make_client():
+            return InProcessClient(server)
+        pids = None
+
+    # Queried periods within the stored data, unless given
+    if args.start and args.end:
+        period = (pd.Timestamp(args.start), pd.Timestamp(args.end))
+    else:
+        from snapshot import open_snapshot
+        partitions = open_snapshot()['1d']
+        first_day, last_day = partitions[0]['datetime_utc'][0], partitions[-1]['datetime_utc'][-1]
+        period = (pd.Timestamp(args.start or pd.Timestamp(int(first_day), unit='s')),
+                  pd.Timestamp(args.end or pd.Timestamp(int(last_day), unit='s')))
+    print("Queried periods between", period[0].date(), "and", period[1].date())
+
+    all_results = []
+    for users in [int(users) for users in args.users.split(',')]:
+        results = run_load(users, args.seconds, make_client, period, pids)
+        print_results(results)
+        all_results.append(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'url': args.url or 'in-process', 'runs': all_results}, file, indent=2)
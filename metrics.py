@@ -0,0 +1,256 @@
+# metrics v0.3
+# Latency instrumentation of the application
+#   Updates from v0.2:
+#   - Label request latencies with the route matched instead of the path, and escape label values
+
+'''
+Time spent in the application is measured with:
+    - spans: named blocks of code timed with 'with span(name):', e.g. data load, range slicing, figure build
+    - callback latencies: Dash callbacks decorated with @timed_callback(name)
+    - request latencies: whole HTTP requests, timed by hooks installed on the Flask server with instrument_server
+      and labelled with the route matched (e.g. '/assets/<path:filename>'), or 'other' for unknown URLs, so that
+      the number of histograms stays bounded whatever the URLs requested; the part of a callback request spent
+      out of the callback is recorded as the 'serialize' span
+    - events: counters incremented with count(name), e.g. cache hits and misses
+    - gauges: values returned by functions registered with register_gauges, read when metrics are rendered
+Latencies are collected in histograms with fixed buckets, and exported by render_metrics in the Prometheus text
+format, served on /metrics by the application. Metrics are kept in memory by each process: with several WSGI
+processes, each scrape returns the metrics of the process serving it.
+
+Slow requests can be profiled by enabling the sampling profiler: a share of callback requests runs under
+cProfile, and the profile of those taking more than slow_ms is written to a file along with their spans.
+'''
+
+# Import librairies
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime as dt
+from functools import wraps
+
+# Upper bounds of histogram buckets in milliseconds, the last bucket holding all greater latencies
+BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Callback latency from which a profiled request is written to a file, in milliseconds
+SLOW_REQUEST_MS = 1000
+
+# Share of callback requests run under the profiler once enabled
+PROFILE_SAMPLE_RATE = 0.1
+
+
+class Histogram:
+    '''
+    Latencies counted in BUCKETS_MS buckets, with their count and sum.
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, milliseconds):
+        index = next((i for i, bound in enumerate(BUCKETS_MS) if milliseconds <= bound), len(BUCKETS_MS))
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.sum += milliseconds
+
+    def cumulative(self):
+        '''
+        Input: None
+        Output: list of (upper bound as text, number of latencies lower than or equal to it), count and sum
+        '''
+        with self.lock:
+            buckets, count, total = list(self.buckets), self.count, self.sum
+        bounds = [str(bound) for bound in BUCKETS_MS] + ['+Inf']
+        running = 0
+        cumulative = []
+        for bound, bucket in zip(bounds, buckets):
+            running += bucket
+            cumulative.append((bound, running))
+        return cumulative, count, total
+
+
+# Histograms by metric name and label value, event counters by name, functions returning gauges by name
+histograms = {}
+counters = {}
+gauge_functions = []
+registry_lock = threading.Lock()
+
+# Spans of the request being served by the current thread
+current_request = threading.local()
+
+# Sampling profiler settings, None while disabled
+profiler_settings = None
+# Only one request is profiled at a time
+profiler_lock = threading.Lock()
+
+
+def _histogram(metric, label):
+    key = (metric, label)
+    histogram = histograms.get(key)
+    if histogram is None:
+        with registry_lock:
+            histogram = histograms.setdefault(key, Histogram())
+    return histogram
+
+
+def observe(metric, label, milliseconds):
+    '''
+    Input: metric name, label value (callback or span name), latency in milliseconds
+    Output: None
+    '''
+    _histogram(metric, label).observe(milliseconds)
+
+
+def count(name, increment=1):
+    '''
+    Input: event name, increment
+    Output: None
+    '''
+    with registry_lock:
+        counters[name] = counters.get(name, 0) + increment
+
+
+def register_gauges(function):
+    '''
+    Input: function without arguments returning a dictionary of numeric values by gauge name
+    Output: None, gauges are rendered as red_wire_<name>
+    '''
+    gauge_functions.append(function)
+
+
+@contextmanager
+def span(name):
+    '''
+    Input: span name
+    Output: context manager timing the code block in the 'span' histogram of name
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        milliseconds = 1000 * (time.perf_counter() - start)
+        observe('span', name, milliseconds)
+        spans = getattr(current_request, 'spans', None)
+        if spans is not None:
+            spans.append((name, round(milliseconds, 3)))
+
+
+def enable_profiler(sample_rate=PROFILE_SAMPLE_RATE, slow_ms=SLOW_REQUEST_MS, path='/tmp/red-wire-profiles/'):
+    '''
+    Input: share of callback requests profiled, latency from which a profile is written,
+           directory of profile files
+    Output: None, profiles are written as <date>_<callback>.prof files readable with pstats
+    '''
+    global profiler_settings
+    os.makedirs(path, exist_ok=True)
+    profiler_settings = {'sample_rate': sample_rate, 'slow_ms': slow_ms, 'path': path}
+
+
+def _write_profile(profiler, name, milliseconds, spans):
+    settings = profiler_settings
+    file_name = f"{dt.now().strftime('%Y%m%dT%H%M%S%f')}_{name}.prof"
+    profiler.dump_stats(os.path.join(settings['path'], file_name))
+    print(f"Slow request: {name} took {milliseconds:.0f} ms, spans: {spans}, profile: {file_name}")
+
+
+def timed_callback(name):
+    '''
+    Input: callback name
+    Output: decorator timing a Dash callback in the 'callback' histogram of name, and profiling a share of its
+            calls when the profiler is enabled
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            current_request.spans = []
+            profiler = None
+            if profiler_settings and random.random() < profiler_settings['sample_rate'] \
+                    and profiler_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                milliseconds = 1000 * (time.perf_counter() - start)
+                observe('callback', name, milliseconds)
+                current_request.callback_ms = getattr(current_request, 'callback_ms', 0) + milliseconds
+                if profiler is not None:
+                    profiler.disable()
+                    profiler_lock.release()
+                    if milliseconds >= profiler_settings['slow_ms']:
+                        _write_profile(profiler, name, milliseconds, current_request.spans)
+                current_request.spans = None
+        return wrapper
+    return decorator
+
+
+def instrument_server(server):
+    '''
+    Input: Flask server of the application
+    Output: None, hooks timing each request are registered on the server
+    '''
+    from flask import request
+
+    @server.before_request
+    def start_request_timer():
+        current_request.start = time.perf_counter()
+        current_request.callback_ms = 0
+
+    @server.after_request
+    def stop_request_timer(response):
+        start = getattr(current_request, 'start', None)
+        if start is not None:
+            milliseconds = 1000 * (time.perf_counter() - start)
+            # Route matched rather than path, which may be any URL sent by clients
+            observe('request', request.url_rule.rule if request.url_rule is not None else 'other', milliseconds)
+            # Time of a callback request spent out of the callback: decoding inputs and serializing outputs
+            if current_request.callback_ms:
+                observe('span', 'serialize', max(milliseconds - current_request.callback_ms, 0))
+            current_request.start = None
+        return response
+
+
+def _escape(value):
+    # Label value escaped as required by the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    '''
+    Input: None
+    Output: metrics of the process in the Prometheus text format
+    '''
+    labels = {'callback': 'callback', 'span': 'span', 'request': 'path'}
+    lines = []
+    with registry_lock:
+        items = sorted(histograms.items())
+        events = sorted(counters.items())
+    for metric in ['callback', 'span', 'request']:
+        name = f'red_wire_{metric}_latency_ms'
+        lines.append(f'# HELP {name} Latency of {metric}s in milliseconds')
+        lines.append(f'# TYPE {name} histogram')
+        for (item_metric, label), histogram in items:
+            if item_metric != metric:
+                continue
+            cumulative, total_count, total_sum = histogram.cumulative()
+            label_text = f'{labels[metric]}="{_escape(label)}"'
+            for bound, value in cumulative:
+                lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {value}')
+            lines.append(f'{name}_sum{{{label_text}}} {total_sum:.3f}')
+            lines.append(f'{name}_count{{{label_text}}} {total_count}')
+    lines.append('# HELP red_wire_events_total Number of events')
+    lines.append('# TYPE red_wire_events_total counter')
+    for event, value in events:
+        lines.append(f'red_wire_events_total{{event="{_escape(event)}"}} {value}')
+    for function in gauge_functions:
+        for gauge, value in function().items():
+            lines.append(f'# TYPE red_wire_{gauge} gauge')
+            lines.append(f'red_wire_{gauge} {value}')
+    return '\n'.join(lines) + '\n'
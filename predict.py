@@ -1,15 +1,223 @@
-# predict v0.3:
+# predict v0.9:
 # Much code commented for test purposes
+#   Updates from v0.8:
+#   - Return batch predictions as rows with 'datetime_utc' and 'prediction', as stored by score.py and plotted
+#     by visualize.py
 
+'''
+Models are pickled scikit-learn estimators. The registry loads each model file once per process and keeps it
+in memory, keyed by path and version (modification time and size of the file), along with its load time and
+memory size (see ModelRegistry.stats). score.py loads the model through the registry and reports its stats, and
+backtest.py loads it before forking its pool of processes, which share its memory.
+A new model file dropped in place of the previous one (write it elsewhere then rename it) is loaded on the next
+call following its detection, while other calls keep using the previous model. A new file that cannot be loaded,
+or whose model is rejected by load_model, is ignored and the previous model kept until another file is dropped in.
+
+In batch mode, the features of all rows of a period are built at once (see build_features), and the model is
+called once on the whole matrix. The columns of the matrix are the features the model was fitted on:
+    - models fitted on a DataFrame name them in feature_names_in_, each being a calendar feature computed from
+      UTC timestamps (CALENDAR_FEATURES), a column of the data (DATA_FEATURES) or a feature conditioned on the
+      forecast origin (ORIGIN_FEATURES), built from the columns added by add_origin
+    - models fitted on arrays take the FEATURE_NAMES columns
+load_model checks that the features of a model can be built, so that a model fitted on other features is rejected
+when loaded instead of failing or mispredicting when called.
+'''
+
+import os
 import pickle
+import threading
+import time
+import tracemalloc
+import numpy as np
 import pandas as pd
 
+# Import constants
+from store import PREDICTION_DTYPE
+
+# Seconds between 2 checks of a model file for a new version
+CHECK_INTERVAL = 10
+
+# Features computed from UTC timestamps in seconds since epoch
+CALENDAR_FEATURES = {
+    'hour': lambda timestamps: (timestamps % 86400) / 3600,
+    'hour_sin': lambda timestamps: np.sin(2 * np.pi * (timestamps % 86400) / 86400),
+    'hour_cos': lambda timestamps: np.cos(2 * np.pi * (timestamps % 86400) / 86400),
+    # 1970-01-01 was a Thursday, shift so that Monday is 0
+    'weekday': lambda timestamps: (timestamps // 86400 + 3) % 7,
+    'month': lambda timestamps: timestamps.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64) % 12 + 1,
+    'year_sin': lambda timestamps: np.sin(2 * np.pi * (timestamps % 31557600) / 31557600),
+    'year_cos': lambda timestamps: np.cos(2 * np.pi * (timestamps % 31557600) / 31557600),
+}
+
+# Features read from columns of the data
+DATA_FEATURES = ['programada', 'prevista']
+
+# Features conditioned on the forecast origin, from the 'origin_utc' and 'demanda_at_origin' columns of add_origin
+ORIGIN_FEATURES = {
+    'hours_ahead': lambda records, timestamps: (timestamps - np.asarray(records['origin_utc'], np.int64)) / 3600,
+    'demanda_at_origin': lambda records, timestamps: np.asarray(records['demanda_at_origin'], dtype=np.float64),
+}
+
+# Columns of the feature matrix given to models fitted on arrays, without feature names
+FEATURE_NAMES = ['hour_sin', 'hour_cos', 'weekday', 'year_sin', 'year_cos', 'programada']
+
+
+def model_features(model):
+    """
+    Args:
+        model: fitted model
+
+    Returns:
+        list: names of the features of the model, in the order of its columns
+
+    Raises:
+        ValueError: if a feature of the model cannot be built
+    """
+    names = getattr(model, 'feature_names_in_', None)
+    if names is None:
+        count = getattr(model, 'n_features_in_', len(FEATURE_NAMES))
+        if count != len(FEATURE_NAMES):
+            raise ValueError(f"Model fitted on {count} unnamed features, expected FEATURE_NAMES: {FEATURE_NAMES}")
+        return list(FEATURE_NAMES)
+    names = [str(name) for name in names]
+    supported = list(CALENDAR_FEATURES) + DATA_FEATURES + list(ORIGIN_FEATURES)
+    unknown = [name for name in names if name not in supported]
+    if unknown:
+        raise ValueError(f"Model features {unknown} cannot be built, supported features: {supported}")
+    return names
+
 
 def load_model(path):
+    """
+    Args:
+        path: path and name of model file
+
+    Returns:
+        model loaded from the file, its features being checked by model_features.
+    """
     with open(path, 'rb') as file:
         model = pickle.load(file)
+    model_features(model)
     return model
 
+
+class ModelRegistry:
+    """Models loaded once per process, keyed by path and version.
+
+    Args:
+        check_interval: seconds between 2 checks of a model file for a new version
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        # Loaded model and its details by path, replaced as a whole on reload
+        self.entries = {}
+        # Only one load per path at a time
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    @staticmethod
+    def file_version(path):
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def _lock(self, path):
+        with self.locks_lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def load(self, path):
+        """Load the current version of a model file, measuring load time and memory allocated.
+        The first load of a process also measures the import of the library of the model, e.g. scikit-learn.
+
+        Args:
+            path: path and name of model file
+
+        Returns:
+            model loaded from the file.
+        """
+        version = self.file_version(path)
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        load_start = time.perf_counter()
+        model = load_model(path)
+        load_time = time.perf_counter() - load_start
+        memory_size = tracemalloc.get_traced_memory()[0] - memory_before
+        if not tracing:
+            tracemalloc.stop()
+        self.entries[path] = {
+            'model': model,
+            'version': version,
+            'load_time_s': round(load_time, 4),
+            'memory_bytes': memory_size,
+            'file_bytes': os.path.getsize(path),
+            'checked_at': time.monotonic(),
+        }
+        return model
+
+    def get(self, path):
+        """Get a model, loading it if needed or if a new version of its file is available.
+
+        Args:
+            path: path and name of model file
+
+        Returns:
+            model loaded from the file.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            with self._lock(path):
+                entry = self.entries.get(path)
+                return entry['model'] if entry else self.load(path)
+        if time.monotonic() - entry['checked_at'] < self.check_interval:
+            return entry['model']
+        # Check for a new version, unless another call already does it
+        lock = self._lock(path)
+        if lock.acquire(blocking=False):
+            try:
+                entry['checked_at'] = time.monotonic()
+                version = self.file_version(path)
+                if version not in (entry['version'], entry.get('rejected_version')):
+                    return self.load(path)
+            except FileNotFoundError:
+                # File being replaced: keep the loaded model
+                pass
+            except Exception as error:
+                # Broken or rejected file: keep the loaded model, and do not load this version again
+                entry['rejected_version'] = version
+                print("Model file not loaded, keeping version", entry['version'], ":", repr(error))
+            finally:
+                lock.release()
+        return self.entries[path]['model']
+
+    def version(self, path):
+        """
+        Args:
+            path: path and name of model file
+
+        Returns:
+            version of the model loaded from the file, None if not loaded.
+        """
+        entry = self.entries.get(path)
+        return entry['version'] if entry else None
+
+    def stats(self):
+        """
+        Returns:
+            list of dictionaries with path, version, load time and memory size of each loaded model.
+        """
+        return [
+            {key: value for key, value in entry.items() if key not in ('model', 'checked_at', 'rejected_version')}
+            | {'path': path}
+            for path, entry in self.entries.items()
+        ]
+
+
+# Registry shared by all calls of a process
+registry = ModelRegistry()
+
+
 def load_data(path, dates):
 #     data_df = pd.read_csv('data/REE_data_aggregated_by_10mn.csv')
 #     data = data_df.loc[data_df["datetime_utc"]==input_values[0], "demanda"].values[0]
@@ -19,23 +227,89 @@ def load_data(path, dates):
 def get_prediction(model, cust_input, input_ids):
     # input_df = pd.DataFrame(cust_input).transpose()
     # input_df.columns = input_ids[0:]
-    print("Modèle en entrée de get_prediction :", model)
     # return model.predict(input_df)[0]
     return 15000
 
 
-def load_model_and_predict(path, cust_input, input_ids):
+def add_origin(targets, history, origins):
+    """
+    Args:
+        targets: structured array of the rows predicted
+        history: structured array of observed rows sorted by time, with 'datetime_utc' and 'demanda'
+        origins: forecast origin of each row of targets, in seconds since epoch
+
+    Returns:
+        dict: columns of targets, with 'origin_utc' and 'demanda_at_origin', the last 'demanda' of history at or
+        before the origin (NaN if none)
+    """
+    columns = {name: targets[name] for name in targets.dtype.names}
+    origins = np.asarray(origins, dtype=np.int64)
+    rows = np.searchsorted(history['datetime_utc'], origins, side='right') - 1
+    demanda = np.asarray(history['demanda'], dtype=np.float64)[np.maximum(rows, 0)] if len(history) else 0
+    columns['origin_utc'] = origins
+    columns['demanda_at_origin'] = np.where(rows >= 0, demanda, np.nan)
+    return columns
+
+
+def build_features(records, names=FEATURE_NAMES):
+    """
+    Args:
+        records: data with 'datetime_utc' (seconds since epoch, strings or datetimes in UTC) and the columns
+            of the DATA_FEATURES in names, and those added by add_origin for ORIGIN_FEATURES
+        names: names of the features, among CALENDAR_FEATURES, DATA_FEATURES and ORIGIN_FEATURES
+
+    Returns:
+        np.ndarray: feature matrix with one row per row of records and one column per name
+    """
+    timestamps = np.asarray(records['datetime_utc']).astype('datetime64[s]').astype(np.int64)
+    return np.column_stack([
+        CALENDAR_FEATURES[name](timestamps) if name in CALENDAR_FEATURES
+        else ORIGIN_FEATURES[name](records, timestamps) if name in ORIGIN_FEATURES
+        else np.asarray(records[name], dtype=np.float64)
+        for name in names
+    ]).astype(np.float64)
+
+
+def get_batch_prediction(model, records):
+    """
+    Args:
+        model: fitted model, its features being given by model_features
+        records: data with 'datetime_utc' and the columns of the data features of the model
+
+    Returns:
+        np.ndarray: structured array of PREDICTION_DTYPE, one row per row of records with 'datetime_utc' in
+        seconds since epoch and the predicted consumption in 'prediction', NaN where features are missing
+    """
+    names = model_features(model)
+    features = build_features(records, names)
+    prediction = np.full(len(features), np.nan)
+    # Single model call on all rows with complete features
+    complete = np.isfinite(features).all(axis=1)
+    if complete.any():
+        matrix = features[complete]
+        if hasattr(model, 'feature_names_in_'):
+            # Named columns, as when the model was fitted
+            matrix = pd.DataFrame(matrix, columns=names)
+        prediction[complete] = model.predict(matrix)
+    predictions = np.empty(len(features), dtype=PREDICTION_DTYPE)
+    predictions['datetime_utc'] = np.asarray(records['datetime_utc']).astype('datetime64[s]').astype(np.int64)
+    predictions['prediction'] = prediction
+    return predictions
+
+
+def load_model_and_predict(path, cust_input, input_ids, records=None):
     """
     Args:
         path: path and name of selected model file
         cust_input: values of selected dates
         input_ids: names of selected dates
+        records: rows of the selected period to predict in batch mode, with 'datetime_utc' and 'programada'
     
     Returns:
-        get_prediction: prediction built from Args.
+        get_prediction: prediction built from Args, or get_batch_prediction: rows of predictions for all rows
+        of records in batch mode, to be plotted with visualize.make_figure_from_prediction.
     """
-    # model = load_model(path)
-    print("Chemin du modèle en entrée de load_model_and_predict :", path)
-    print("Données en entrée de load_model_and_predict :", cust_input)
-    model = "fake model"
+    model = registry.get(path)
+    if records is not None:
+        return get_batch_prediction(model, records)
     return get_prediction(model, cust_input, input_ids)
\ No newline at end of file
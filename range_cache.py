@@ -0,0 +1,98 @@
+# range_cache v0.3
+# Bounded cache of query results keyed by time range
+#   Updates from v0.2:
+#   - Hold the figure update of a period only, not the rows it was built from
+
+'''
+Users often request the same periods (last week, last month, same month last year), so the results of a range
+query are kept in a least recently used cache, keyed by:
+    (start, end, aggregation duration, data version)
+An entry holds the figure update returned for the period, its traces already encoded as base64 typed arrays, so
+that a repeated query only costs a dictionary lookup. The rows it was built from are not kept: they are views of
+the memory-mapped snapshot, sliced again on a miss. The size of an entry is the size of the update serialized to
+JSON (see visualize.patch_bytes).
+
+The cache is bounded by the size of its entries, given by the caller when adding them: least recently used
+entries are evicted until the total size fits in max_bytes. Entries of a previous data version are never hit
+again, so they are all dropped as soon as an entry of a new version is added.
+Each process holds its own cache, its hit ratio is reported by stats().
+The same cache also holds tile payloads of the tile pyramid, keyed by (level, tile, data version), see tiles.py.
+'''
+
+# Import librairies
+import threading
+from collections import OrderedDict
+
+# Maximum total size of cached entries in bytes
+MAX_BYTES = 64 * 1024 * 1024
+
+
+class RangeCache:
+    '''
+    Least recently used cache of range query results, bounded by max_bytes, the total size of its entries.
+    '''
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        # (value, size) by key, from the least to the most recently used
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Input: key ending with the data version, e.g. (start, end, duration, data version)
+        Output: cached value, None if the key is not cached
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        '''
+        Input: key ending with the data version, value to cache, its size in bytes
+        Output: None, least recently used entries are evicted to make room for the value
+        '''
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            # Entries of a previous data version are obsolete
+            version = key[-1]
+            if version != self.version:
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            while self.entries and self.bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+    def stats(self):
+        '''
+        Input: None
+        Output: dictionary of number of entries, size in bytes, hits, misses, evictions and hit ratio
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -1,6 +1,6 @@
-# red_wire_app v1.3
-#   Updates from v1.2:
-#   - Import constants from utils.py
+# red_wire_app v1.27
+#   Updates from v1.26:
+#   - Remove the unused pandas import
 
 
 ##################
@@ -9,22 +9,24 @@
 
 # Import Python librairies
 import numpy as np
-import pandas as pd
-from datetime import datetime as dt, timedelta
+from datetime import datetime as dt
 
 import dash
 import dash_bootstrap_components as dbc
 from dash import html, dcc
 from dash.dash import no_update
-from dash_extensions.enrich import Output, DashProxy, Input, State, MultiplexerTransform
+from dash_extensions.enrich import ClientsideFunction, Output, DashProxy, Input, State, MultiplexerTransform
 from dash.exceptions import PreventUpdate
-from flask_caching import Cache
+from flask import Response
 
 # Import functions and constants
-from predict import load_model_and_predict, load_data
-from connect import create_session, get_last_connection_date, register_new_connection
-from visualize import make_figure_from_prediction
-from utils import moment, APP_PATH, DATA_PATH, DATA_REF
+from connect import record_connection
+from metrics import count, enable_profiler, instrument_server, register_gauges, render_metrics, span, timed_callback
+from range_cache import RangeCache
+from visualize import encode_trace, make_figure_patch, make_figure_payload, make_traces_patch, patch_bytes
+from snapshot import SnapshotWatcher, open_predictions, open_snapshot
+from store import STORE_DTYPE, pick_duration, slice_partitions, to_epoch
+from tiles import load_window
 
 
 #################################
@@ -41,6 +43,18 @@ HIDE_HOME_BUTTON = False
 # Flag to control console output
 CONSOLE_OUTPUT = False
 
+# Flag to write user connections to the database in the background, the greeting only waiting for a read
+ASYNC_CONNECTION_LOG = True
+
+# Flag to profile a share of callback requests and write the profiles of slow ones (see metrics.py)
+PROFILE_SLOW_REQUESTS = False
+
+# Maximum size of the cache of range query results of a process, in bytes
+RANGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Maximum size of the cache of tile payloads of a process, in bytes
+TILE_CACHE_BYTES = 32 * 1024 * 1024
+
 
 ############################
 # Set user input variables #
@@ -63,10 +77,8 @@ input_notes =   ["Saisissez une date au format AAAA-MM-JJ", "Saisissez une date
 
 # Function to determine greeting text on user connection
 def get_greeting_text(name):
-    session = create_session()
-    last_date = get_last_connection_date(session, name)
-    register_new_connection(session, name)
-    session.commit()
+    with span('db_login'):
+        last_date = record_connection(name, asynchronous=ASYNC_CONNECTION_LOG)
 
     if last_date is None:
         text1 = f"Bonjour {name}"
@@ -90,17 +102,31 @@ app = DashProxy(
 )
 app.title = 'Red Wire App.'
 
-# Define and configure a cache system
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': '/var/www/.cache/cache-directory',
-})
+# Define a function to load a snapshot of the store and its predictions
+# Data is a list of read-only structured arrays sorted by 'datetime_utc' (int64 seconds since epoch), one per year,
+# for each duration, memory-mapped so that its pages are shared by all WSGI processes instead of each of them
+# holding a private copy
+# Predictions of the model are precomputed by score.py and stored the same way
+def load_snapshot(version):
+    return open_snapshot(version), open_predictions(version)
+
+# Current snapshot, replaced in the background when the ingest job publishes a new one
+snapshot_watcher = SnapshotWatcher(load=load_snapshot)
+
+# Define a function to get the version of the current snapshot, and its data and predictions by duration,
+# both from the same snapshot even if a refresh happens meanwhile
+def cached_snapshot():
+    # Only the first request of a process waits for the snapshot to be loaded
+    count('snapshot_miss' if snapshot_watcher.current is None else 'snapshot_hit')
+    return snapshot_watcher.get_with_version()
 
-# Define a function to load the data using the cache system
-@cache.memoize()
-def cached_data():
-    data_df = pd.read_csv(APP_PATH+DATA_PATH+DATA_REF, delimiter=',')
-    return data_df
+# Results of range queries (sliced rows and figure update) by period, aggregation duration and data version
+range_cache = RangeCache(RANGE_CACHE_BYTES)
+register_gauges(lambda: {f'range_cache_{name}': value for name, value in range_cache.stats().items()})
+
+# Tile payloads of the tile pyramid by level, tile number and data version, built on first use
+tile_cache = RangeCache(TILE_CACHE_BYTES)
+register_gauges(lambda: {f'tile_cache_{name}': value for name, value in tile_cache.stats().items()})
 
 # Application name and logo displayed on top left of all tabs
 logo_and_title = dbc.Row(
@@ -170,6 +196,7 @@ for i in range(0, len(input_ids)):
     )
 
 # Function to increment active_tab_number and get to the next tab
+# getNextTab in assets/navigation.js does the same in the browser
 def get_next_tab(active_tab):
     # Extract the 5th character of active_tab_number, which is the current tab number
     active_tab_number = int(active_tab[4:])
@@ -180,6 +207,68 @@ def get_next_tab(active_tab):
         return f"tab-{active_tab_number + 1}"
 
 
+# Function to get the start and end dates of a period validated by the browser
+# Warnings are displayed by the browser, which only sends valid periods: check them again, as requests may not come
+# from the application
+def get_period_dates(period):
+    dates = [period.get('start'), period.get('end')] if isinstance(period, dict) else [None, None]
+    if dates[0] is None or dates[1] is None:
+        raise PreventUpdate
+    try:
+        start, end = (dt.strptime(date, '%Y-%m-%d') for date in dates)
+    except (TypeError, ValueError):
+        # Not a date in YYYY-MM-DD format
+        raise PreventUpdate
+    if end < start or (end - start).days > 92:
+        raise PreventUpdate
+    return dates
+
+
+# Function to get the visible time window of the graph from its relayoutData
+def get_visible_window(relayout_data, start, end):
+    # Back to the whole selected period when the graph is reset
+    if relayout_data.get('xaxis.autorange'):
+        return start + " 00:00:00", end + " 23:59:59"
+    # Window set by zooming or panning
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    # Other layout changes (legend, y-axes, autosize...) do not change the window
+    return None
+
+
+# Function to get the figure update of a period, from range_cache or built from the rows of the current snapshot
+def get_period_figure(start_date, end_date, cache=range_cache):
+    # Use the coarsest aggregation duration still giving enough points over the requested period
+    duration = pick_duration(start_date, end_date)
+    if CONSOLE_OUTPUT:
+        print("Aggregation duration:", duration)
+    with span('data_load'):
+        version, (data, predictions) = cached_snapshot()
+        data, predictions = data[duration], predictions[duration]
+
+    # Period already requested with the same data
+    key = (start_date, end_date, duration, version)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Rows within the requested period, a zero-copy view unless the period spans 2 years
+    with span('slice'):
+        start_epoch, end_epoch = to_epoch([start_date, end_date])
+        figure_df = slice_partitions(data, start_epoch, end_epoch)
+        # Predictions of the model over the period, precomputed by score.py: no model is called in this request
+        prediction = slice_partitions(predictions, start_epoch, end_epoch)
+
+    with span('figure_build'):
+        # Keep zoom and pan state until another period is selected
+        prediction_figure = make_figure_patch(figure_df, prediction=prediction, uirevision=start_date + end_date)
+    # Only the figure update is kept, its typed arrays already encoded as sent to the browser
+    cache.put(key, prediction_figure, patch_bytes(prediction_figure))
+    return prediction_figure
+
+
 #######################
 # Configure Dash tabs #
 #######################
@@ -342,7 +431,11 @@ tabs = dbc.Tabs([
                                 html.H5(f"Comparaison graphique des valeurs de consommations réelle, planifiée et prédite"),
                                 style={"color": "red"},
                                 className="text-center pt-3"),
-                            dbc.CardBody(dcc.Graph(id="prediction-graph")),
+                            # Empty traces and layout, callbacks only replace the data of traces
+                            dbc.CardBody(dcc.Graph(
+                                id="prediction-graph",
+                                figure=make_figure_payload(np.empty(0, dtype=STORE_DTYPE)),
+                            )),
                         ]),
                         className="mb-2"
                     ),
@@ -382,6 +475,8 @@ app.layout = dbc.Container([
                 [
                     logo_and_title,
                     home_button,
+                    # Period validated in the browser and sent to the server by the Parameters tab
+                    dcc.Store(id="valid-period"),
                     dbc.Row(
                         [
                             dbc.Col(tabs)
@@ -420,28 +515,44 @@ app.layout = dbc.Container([
 # Define Dash CallBacks #
 #########################
 
-# Callback to manage Home button
-@app.callback(
+# Navigation callbacks run in the browser (functions of assets/navigation.js), without any request to the server
+
+# Clientside callback to manage Home button
+app.clientside_callback(
+    ClientsideFunction(namespace="navigation", function_name="home_button"),
     Output(component_id="tabs", component_property="active_tab"),
 
     Input(component_id="home-button", component_property="n_clicks"),
 )
-def home_button(n_clicks):
-    return "tab-0"
 
 
-# Callback to manage Start and (application) Launch buttons on Home and Welcome tabs
-@app.callback(
+# Clientside callback to manage Start and (application) Launch buttons on Home and Welcome tabs
+app.clientside_callback(
+    ClientsideFunction(namespace="navigation", function_name="button_to_next_tab"),
     Output(component_id="tabs", component_property="active_tab"),
 
-    State(component_id="tabs", component_property="active_tab"),
-
+    # Clientside callbacks take inputs before states
     Input(component_id="start-button", component_property="n_clicks"),
     Input(component_id="launch-button", component_property="n_clicks"),
     Input(component_id="param-button", component_property="n_clicks"),
+
+    State(component_id="tabs", component_property="active_tab"),
+)
+
+
+# Clientside callback to validate the selected period, only a valid period being sent to get_result_callback
+app.clientside_callback(
+    ClientsideFunction(namespace="navigation", function_name="validate_period"),
+    Output(component_id="valid-period", component_property="data"),
+    Output(component_id="tabs", component_property="active_tab"),
+    Output(component_id="alert-0", component_property="is_open"),
+    Output(component_id="alert-1", component_property="is_open"),
+
+    Input(component_id="predict-button", component_property="n_clicks"),
+    State(component_id=input_ids[0], component_property="value"),
+    State(component_id=input_ids[1], component_property="value"),
+    State(component_id="tabs", component_property="active_tab"),
 )
-def button_to_next_tab(active_tab, *args):
-    return get_next_tab(active_tab)
 
 
 # Callback to manage input for user identification
@@ -457,6 +568,7 @@ def button_to_next_tab(active_tab, *args):
 
     Input(component_id="connect-button", component_property="n_clicks"),
 )
+@timed_callback('enter_id_callback')
 def enter_id_callback(name, active_tab, n_clicks):
     if name is None:
         return no_update, no_update, True
@@ -465,68 +577,29 @@ def enter_id_callback(name, active_tab, n_clicks):
 
     return text1, text2, get_next_tab(active_tab), False
 
-# Main callback to collect model input parameters, launch model prediction and trigger Result tab
+# Main callback to collect model input parameters, launch model prediction and build the graph of the Result tab
 @app.callback(
     # Output(component_id="prediction-card", component_property="children"),
     Output(component_id="prediction-graph", component_property="figure"),
-    Output(component_id="tabs", component_property="active_tab"),
-    Output(component_id="alert-0", component_property="is_open"),
-    Output(component_id="alert-1", component_property="is_open"),
-
-    # Collect start and end dates
-    inputs=[(State(component_id=input_ids[0], component_property="value"),
-    State(component_id=input_ids[1], component_property="value")),
-
-    State(component_id="tabs", component_property="active_tab"),
 
-    Input(component_id="predict-button", component_property="n_clicks")],
+    # Collect start and end dates validated by the browser
+    Input(component_id="valid-period", component_property="data"),
 )
-def get_result_callback(input_values, active_tab, n_clicks):
-
+@timed_callback('get_result_callback')
+def get_result_callback(period):
     if CONSOLE_OUTPUT:
         print("******************************")
-        print("Start date:", input_values[0])
-        print("End date :", input_values[1])
-
-    # Trigger a warning for blank user input
-    empty_start = (input_values[0] == None)
-    empty_end = (input_values[1] == None)
-    if empty_start or empty_end:
-        return no_update, no_update, empty_start, empty_end
-    # Trigger a warning for invalid time interval
-    else:
-        invalid_time_interval = (input_values[1] < input_values[0]) \
-        or (dt.strptime(input_values[1], '%Y-%m-%d') - dt.strptime(input_values[0], '%Y-%m-%d')).days > 92
-    if invalid_time_interval:
-        return no_update, no_update, False, True
-
-    # Load data from cache
-    data_df = cached_data()
-    # Get the most recent date of cached data
-    date_of_cached_data = dt.strptime(data_df.tail(1)['datetime_utc'].values[0], '%Y-%m-%d %H:%M:%S')
-    # Set the date (23:50 UTC everyday) at which most recent data should be available from disk
-    date_of_available_data = moment('yesterday', 'PM') - timedelta(minutes=9)
-    # Data needs to be reloaded if older than the most recent available data
-    reload_needed = date_of_cached_data < date_of_available_data
+        print("Selected period:", period)
+
+    input_values = get_period_dates(period)
+
+    # Data is kept up to date by snapshot_watcher, no reload happens in this request
     if CONSOLE_OUTPUT:
-        print("Date of cached data:", date_of_cached_data)
-        print("Date of most recent data:", date_of_available_data)
-        print("Reload needed:", reload_needed)
-    if reload_needed:
-        if CONSOLE_OUTPUT:
-            print("Refreshing cache from data file...")
-        cache.delete_memoized(cached_data)
-        data_df = cached_data()
-
-    input_values[0]+=" 00:00:00"
-    input_values[1]+=" 23:59:59"
-    start_date = dt.strptime(input_values[0], '%Y-%m-%d %H:%M:%S')
-    end_date = dt.strptime(input_values[1], '%Y-%m-%d %H:%M:%S')
-    data_df['datetime_utc'] = pd.to_datetime(data_df['datetime_utc'])
-    mask = (data_df['datetime_utc'] >= start_date) & (data_df['datetime_utc'] <= end_date)
-    figure_df = data_df.loc[mask]
+        print("Data version:", snapshot_watcher.version)
+
+    # Rows and predictions of the period sliced from the current snapshot, no model is called in this request
+    prediction_figure = get_period_figure(input_values[0] + " 00:00:00", input_values[1] + " 23:59:59")
     # actual_val=data_df.loc[data_df["datetime_utc"]==input_values[0], "demanda"].values[0]
-    # prediction = load_model_and_predict(app_path+'data/Red_Wire_model', input_values, input_ids)
 
     # if CONSOLE_OUTPUT:
     #     print("********************")
@@ -565,15 +638,61 @@ def get_result_callback(input_values, active_tab, n_clicks):
 
     # prediction_text = prediction_element + conclusion_element
     # prediction_figure = make_figure_from_prediction(actual_val, prediction)
-    prediction_figure = make_figure_from_prediction(figure_df)
 
     # return prediction_text, prediction_figure, get_next_tab(active_tab), False, False
-    return prediction_figure, get_next_tab(active_tab), False, False
+    # The Result tab is shown by the browser when the period is validated
+    return prediction_figure
+
+# Callback to reload the graph with the tiles covering the visible window when zooming or panning
+@app.callback(
+    Output(component_id="prediction-graph", component_property="figure"),
+
+    # Collect start and end dates of the plotted period, validated by the browser
+    State(component_id="valid-period", component_property="data"),
+
+    Input(component_id="prediction-graph", component_property="relayoutData"),
+)
+@timed_callback('zoom_graph_callback')
+def zoom_graph_callback(period, relayout_data):
+    if relayout_data is None:
+        raise PreventUpdate
+    start, end = get_period_dates(period)
+    window = get_visible_window(relayout_data, start, end)
+    if window is None:
+        raise PreventUpdate
+    try:
+        to_epoch(list(window))
+    except (TypeError, ValueError):
+        # Not a date
+        raise PreventUpdate
+
+    with span('data_load'):
+        version, (data, predictions) = cached_snapshot()
+    # Tile payloads are already downsampled, only tiles missing from the cache are built
+    with span('tile_load'):
+        level, traces = load_window(window[0], window[1], data, predictions, tile_cache, version)
+    if CONSOLE_OUTPUT:
+        print("Visible window:", window, "- pyramid level:", level, "- points:", len(traces[0][0]))
+
+    with span('figure_build'):
+        # Revision of the selected period unchanged, so the zoom state of the graph is kept
+        zoom_figure = make_traces_patch([encode_trace(x, y) for x, y in traces])
+    return zoom_figure
 
 # End of code managing the user interface using Dash tabs and callbacks
 
 
 # Hook for WSGI (Web Server Gateway Interface)
 server = app.server
+
+# Time all requests and export latency histograms of the process in the Prometheus text format
+instrument_server(server)
+if PROFILE_SLOW_REQUESTS:
+    enable_profiler()
+
+@server.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run_server(debug=DASH_DEBUG)
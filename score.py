@@ -0,0 +1,141 @@
+# score v0.5
+# Precomputed predictions of the model over the stored data
+#   Updates from v0.4:
+#   - Store the rows of predictions returned by get_batch_prediction as they are
+
+'''
+Predictions of the model are computed once after each ingest instead of in application requests, and stored with
+the same layout and functions as the data they are computed from (see store.py):
+    STORE_PATH/predictions/10mn/2024.npy, ..., STORE_PATH/predictions/1d/2024.npy
+    STORE_PATH/predictions/MODEL_VERSION: version of the model file used to compute the stored predictions
+Each row holds datetime_utc and prediction (PREDICTION_DTYPE).
+
+New 10mn rows of the store are scored with a single model call, then 1h and 1d predictions are rolled up from the
+10mn predictions of the steps touched, as ingest.py does for data. Rows from the last stored prediction onwards
+are scored again, since the last 10mn row may have been completed by the ingest.
+Predictions are day-ahead: the forecast origin of a row is the previous midnight UTC, so that models using
+features of the origin (see predict.ORIGIN_FEATURES) only see the data observed up to it.
+When the model file changed since the last run, all predictions are computed again with the new model in
+STORE_PATH/predictions.new, which then replaces the prediction store: until then, the predictions of the previous
+model stay complete, and a failed run leaves them in place.
+Predictions are published with the data by the next snapshot, and the application only slices them.
+
+Run 'python3 score.py' after ingesting new data, then publish a snapshot: daily_update.py and catch-up_data.py
+run ingest, score and snapshot.publish_snapshot in this order.
+'''
+
+# Import librairies
+import os
+import shutil
+import pandas as pd
+
+# Import functions and constants
+from predict import add_origin, get_batch_prediction, registry
+from store import (DURATIONS, PREDICTION_DIRECTORY, PREDICTION_DTYPE, STEPS, last_timestamp, read_range, rollup,
+                   upsert_store)
+from utils import MODEL_PATH, STORE_PATH
+
+# Seconds between 2 forecast origins: predictions are made each day at midnight UTC for the next day
+ORIGIN_STEP = 86400
+
+
+def stored_model_version(prediction_path):
+    '''
+    Input: path of the prediction store
+    Output: version of the model file used to compute the stored predictions, None if nothing is stored
+    '''
+    try:
+        with open(os.path.join(prediction_path, 'MODEL_VERSION'), 'r') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_model_version(prediction_path, version):
+    '''
+    Input: path of the prediction store, version of the model file used to compute the stored predictions
+    Output: None, the version file is replaced atomically
+    '''
+    temp_path = os.path.join(prediction_path, 'MODEL_VERSION.tmp')
+    with open(temp_path, 'w') as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, os.path.join(prediction_path, 'MODEL_VERSION'))
+
+
+def swap_directory(new_path, path):
+    '''
+    Input: path of a complete new directory, path of the directory it replaces
+    Output: None, new_path is renamed to path and the replaced directory is removed
+    '''
+    old_path = path.rstrip('/') + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(new_path, path)
+    # Snapshots hold hard links to the replaced partitions, which stay readable
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def score(model_path=MODEL_PATH, store_path=STORE_PATH):
+    '''
+    Input: path and name of the model file, path of the store
+    Output: dictionary with the number of predictions written for each duration, and the version, load time and
+            memory size of the model
+    '''
+    written = {}
+    if not os.path.exists(model_path):
+        print("Model file not found, no prediction computed:", model_path)
+        return written
+    prediction_path = os.path.join(store_path, PREDICTION_DIRECTORY)
+    os.makedirs(prediction_path, exist_ok=True)
+
+    # Version of the loaded model, even if the file is replaced meanwhile
+    model = registry.get(model_path)
+    version = registry.version(model_path)
+    written['model'] = [stats for stats in registry.stats() if stats['path'] == model_path][0]
+
+    # Predictions computed with another version of the model are kept until all rows are scored again
+    current_path = prediction_path
+    if stored_model_version(prediction_path) != version:
+        print("New model version, computing all predictions:", version)
+        prediction_path = os.path.join(store_path, PREDICTION_DIRECTORY + '.new')
+        shutil.rmtree(prediction_path, ignore_errors=True)
+        os.makedirs(prediction_path)
+
+    # 10mn rows from the last stored prediction onwards
+    last_row = last_timestamp('10mn', store_path)
+    if last_row is None:
+        return written
+    last_prediction = last_timestamp('10mn', prediction_path)
+    first_row = 0 if last_prediction is None else last_prediction
+    # Rows from the forecast origin of the first row, observed data at the origins
+    first_origin = max(0, (first_row - 1) // ORIGIN_STEP * ORIGIN_STEP)
+    history = read_range('10mn', pd.Timestamp(first_origin, unit='s'), pd.Timestamp(last_row, unit='s'), store_path)
+    records = history[history['datetime_utc'] >= first_row]
+    if len(records) == 0:
+        return written
+
+    # Single model call on all new rows, each predicted from the previous midnight
+    origins = (records['datetime_utc'] - 1) // ORIGIN_STEP * ORIGIN_STEP
+    predictions = get_batch_prediction(model, add_origin(records, history, origins))
+    written['10mn'] = len(upsert_store(predictions, '10mn', prediction_path))
+
+    # Coarser durations rolled up from the stored 10mn predictions of the steps touched by new predictions
+    last_10mn = pd.Timestamp(last_row, unit='s')
+    for duration in DURATIONS[1:]:
+        first_step = pd.Timestamp(int(records['datetime_utc'][0] // STEPS[duration] * STEPS[duration]), unit='s')
+        touched = read_range('10mn', first_step, last_10mn, prediction_path, dtype=PREDICTION_DTYPE)
+        written[duration] = len(upsert_store(rollup(touched, duration), duration, prediction_path))
+
+    write_model_version(prediction_path, version)
+    if prediction_path != current_path:
+        swap_directory(prediction_path, current_path)
+
+    return written
+
+
+# Compute predictions for the rows ingested since the last run
+if __name__ == '__main__':
+    print("Predictions written:", score())
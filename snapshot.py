@@ -0,0 +1,250 @@
+# snapshot v0.7
+# Immutable snapshots of the binary store shared by application processes
+#   Updates from v0.6:
+#   - Read partitioned snapshots only
+
+'''
+The store holds one partition file per duration and per year, each file being written to a temporary file then
+renamed, and never modified afterwards. A snapshot is a directory of hard links to the partition files of the
+store at the time it is published:
+    STORE_PATH/snapshots/<version>/10mn/2014.npy, ..., 1d/2024.npy
+    STORE_PATH/snapshots/<version>/predictions/10mn/2014.npy, ...: predictions of the model, when computed
+    STORE_PATH/CURRENT: version of the current snapshot
+Publishing a snapshot therefore copies no data: partitions left unchanged since the previous snapshot are shared
+with it, and a partition rewritten by an ingest is a new file, linked by the new snapshot only. Files are copied
+only if the file system does not support hard links.
+
+Application processes memory-map the partition files of the current snapshot: pages are shared between all WSGI
+processes through the system page cache, and nothing is copied or unpickled when loading data. A duration is
+loaded as the list of its partitions in time order, sliced with store.slice_partitions.
+A new snapshot is published once per run of the daily pipeline, after ingest.py and score.py, then CURRENT is
+replaced atomically, so a process reads either the previous or the new snapshot, never a partial one.
+A replaced snapshot is removed once the snapshot replacing it was published RETENTION seconds ago, long enough for
+every process to load a newer snapshot and for requests using the replaced one to end. The last KEEP_SNAPSHOTS
+snapshots are always kept.
+
+CURRENT is also the data version marker: each process runs a SnapshotWatcher thread checking its modification
+time and loading the new snapshot in the background when it changes. Requests keep being served with the
+previous snapshot until the new one is loaded, and never wait for a reload.
+'''
+
+# Import librairies
+import os
+import shutil
+import threading
+import time
+from datetime import datetime as dt, timezone
+import numpy as np
+
+# Import functions and constants
+from store import DURATIONS, PREDICTION_DIRECTORY, PREDICTION_DTYPE, STORE_DTYPE, partition_files
+from utils import STORE_PATH
+
+# Number of snapshots always kept on disk, the current one and the previous one
+KEEP_SNAPSHOTS = 2
+
+# Seconds between 2 checks of CURRENT by a SnapshotWatcher
+REFRESH_INTERVAL = 30
+
+# Seconds a replaced snapshot is kept after the publication of the snapshot replacing it, so that processes still
+# mapping it have refreshed several times
+RETENTION = 10 * REFRESH_INTERVAL
+
+# Format of snapshot versions, their publication time in UTC
+VERSION_FORMAT = '%Y%m%dT%H%M%S%f'
+
+
+def current_version(path=STORE_PATH):
+    '''
+    Input: path of the store
+    Output: version of the current snapshot, None if no snapshot was published
+    '''
+    try:
+        with open(os.path.join(path, 'CURRENT'), 'r') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _link_partitions(source, destination):
+    # Hard-link the partition files of all durations of a store into a snapshot directory
+    for duration in DURATIONS:
+        os.makedirs(os.path.join(destination, duration))
+        for file in partition_files(duration, source):
+            target = os.path.join(destination, duration, os.path.basename(file))
+            try:
+                os.link(file, target)
+            except OSError:
+                # File system without hard links, or store on another file system
+                shutil.copyfile(file, target)
+
+
+def publish_snapshot(path=STORE_PATH):
+    '''
+    Input: path of the store
+    Output: version of the published snapshot
+    '''
+    version = dt.now(timezone.utc).strftime(VERSION_FORMAT)
+    directory = os.path.join(path, 'snapshots', version)
+    os.makedirs(directory)
+    _link_partitions(path, directory)
+    _link_partitions(os.path.join(path, PREDICTION_DIRECTORY), os.path.join(directory, PREDICTION_DIRECTORY))
+
+    # Switch to the new snapshot
+    temp_path = os.path.join(path, 'CURRENT.tmp')
+    with open(temp_path, 'w') as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, os.path.join(path, 'CURRENT'))
+
+    remove_snapshots(path)
+    return version
+
+
+def remove_snapshots(path=STORE_PATH, retention=RETENTION):
+    '''
+    Input: path of the store, seconds a replaced snapshot is kept
+    Output: list of removed versions, replaced by a snapshot published more than retention seconds ago and not
+            among the last KEEP_SNAPSHOTS
+    '''
+    # Publication times of snapshots, in time order
+    published = []
+    for version in sorted(os.listdir(os.path.join(path, 'snapshots'))):
+        try:
+            published.append((version, dt.strptime(version, VERSION_FORMAT).replace(tzinfo=timezone.utc)))
+        except ValueError:
+            # Not a snapshot directory
+            pass
+    now = dt.now(timezone.utc)
+    removed = []
+    for (old_version, _), (_, replaced_at) in zip(published[:-KEEP_SNAPSHOTS], published[1:]):
+        if (now - replaced_at).total_seconds() > retention:
+            shutil.rmtree(os.path.join(path, 'snapshots', old_version), ignore_errors=True)
+            removed.append(old_version)
+    return removed
+
+
+def _open_partitions(directory, duration, dtype):
+    # Read-only memory-mapped partitions of a duration in a snapshot directory, in time order
+    partitions = [np.load(file, mmap_mode='r') for file in partition_files(duration, directory)]
+    return partitions or [np.empty(0, dtype=dtype)]
+
+
+def open_snapshot(version=None, path=STORE_PATH):
+    '''
+    Input: version of a snapshot, the current one if None, path of the store
+    Output: dictionary of lists of read-only memory-mapped structured arrays (partitions in time order)
+            by duration
+    '''
+    if version is None:
+        version = current_version(path)
+    if version is None:
+        raise FileNotFoundError(f"No snapshot published in {path}, run store.py to build the store")
+    directory = os.path.join(path, 'snapshots', version)
+    return {
+        duration: _open_partitions(directory, duration, STORE_DTYPE)
+        for duration in DURATIONS
+    }
+
+
+def open_predictions(version=None, path=STORE_PATH):
+    '''
+    Input: version of a snapshot, the current one if None, path of the store
+    Output: dictionary of lists of read-only memory-mapped structured arrays of predictions (partitions in time
+            order) by duration, holding an empty array for durations without predictions in the snapshot
+    '''
+    if version is None:
+        version = current_version(path)
+    directory = os.path.join(path, 'snapshots', str(version))
+    return {
+        duration: _open_partitions(os.path.join(directory, PREDICTION_DIRECTORY), duration, PREDICTION_DTYPE)
+        for duration in DURATIONS
+    }
+
+
+class SnapshotWatcher:
+    '''
+    Keeps the current snapshot loaded in a process and refreshes it in the background when CURRENT changes.
+
+    Args:
+        load: function loading a snapshot from its version, open_snapshot by default; it may also prepare
+              data derived from the snapshot, so that derived data is refreshed along with it
+        path: path of the store
+        interval: seconds between 2 checks of CURRENT
+    '''
+
+    def __init__(self, load=None, path=STORE_PATH, interval=REFRESH_INTERVAL):
+        self.load = load or (lambda version: open_snapshot(version, path))
+        self.path = path
+        self.interval = interval
+        # (modification time of CURRENT, version, loaded snapshot), replaced as a whole on refresh
+        self.current = None
+        # Only one refresh at a time
+        self.refresh_lock = threading.Lock()
+        # Process in which the watching thread runs, a forked WSGI process starts its own thread
+        self.thread_pid = None
+        self.thread_lock = threading.Lock()
+
+    def _marker_mtime(self):
+        try:
+            return os.stat(os.path.join(self.path, 'CURRENT')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        '''
+        Input: None
+        Output: True if a new snapshot was loaded; returns at once if another refresh is in progress
+        '''
+        if not self.refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            mtime = self._marker_mtime()
+            if self.current is not None and mtime == self.current[0]:
+                return False
+            version = current_version(self.path)
+            self.current = (mtime, version, self.load(version))
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as error:
+                # Keep serving the loaded snapshot and try again at the next check
+                print("Snapshot refresh failed:", error)
+
+    def get(self):
+        '''
+        Input: None
+        Output: loaded snapshot, as returned by the load function
+
+        Only the first call of a process loads the snapshot synchronously, later calls return the loaded one.
+        '''
+        return self.get_with_version()[1]
+
+    def get_with_version(self):
+        '''
+        Input: None
+        Output: version and loaded snapshot, both from the same refresh
+        '''
+        with self.thread_lock:
+            if self.thread_pid != os.getpid():
+                self.thread_pid = os.getpid()
+                threading.Thread(target=self._watch, name='snapshot-watcher', daemon=True).start()
+        while self.current is None:
+            # Wait for a first load in progress in another thread, or load the snapshot
+            with self.refresh_lock:
+                pass
+            if self.current is None:
+                self.refresh()
+        _, version, loaded = self.current
+        return version, loaded
+
+    @property
+    def version(self):
+        return None if self.current is None else self.current[1]
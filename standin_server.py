@@ -0,0 +1,166 @@
+# standin_server v0.1
+# Local stand-in for the REE API, serving synthetic data to check the backfill engine
+
+'''
+The stand-in server answers GET requests with the parameters sent by API_request ('start_date', 'end_date' in
+Europe/Madrid time) with a body shaped like REE responses, built by benchmark.make_raw_response from synthetic 10mn
+rows (benchmark.generate_records). Each response also holds the rows of the OVERLAP seconds following the end of
+the requested window, as REE returns rows at window boundaries, so that consecutive windows overlap.
+The server records the arrival time of each request and the maximum number of requests served at once.
+
+Running 'python3 standin_server.py' starts the server on a free local port and checks backfill.py against it:
+    - windows: contiguous, each of WINDOW at most, covering the whole range
+    - concurrency: at most max_workers requests served at once
+    - rate limiting: requests spaced by at least 1 / requests_per_second seconds
+    - merge: rows of all windows merged in time order, overlapping rows kept once, equal to the served rows
+'''
+
+# Import librairies
+import sys
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+
+# Import functions
+from benchmark import generate_records, make_raw_response
+
+# Seconds of rows following the end of a requested window also returned by the server
+OVERLAP = 3600
+
+# Seconds spent by the server on each request, so that concurrent requests overlap
+DELAY = 0.2
+
+# Settings of the backfill checked: days collected, workers and requests per second
+CHECK_DAYS = 12
+CHECK_WORKERS = 3
+CHECK_REQUESTS_PER_SECOND = 8
+
+
+class StandinServer(ThreadingHTTPServer):
+    '''
+    HTTP server holding the rows served and statistics of the requests received.
+    '''
+    daemon_threads = True
+
+    def __init__(self, records, overlap=OVERLAP, delay=DELAY, port=0):
+        super().__init__(('127.0.0.1', port), StandinHandler)
+        self.records = records
+        self.overlap = overlap
+        self.delay = delay
+        self.arrivals = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.arrivals.append(time.monotonic())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            params = parse_qs(urlparse(self.path).query)
+            start, end = (pd.Timestamp(params[name][0]).tz_convert('UTC').value // 10**9
+                          for name in ['start_date', 'end_date'])
+            timestamps = server.records['datetime_utc']
+            rows = server.records[(timestamps >= start) & (timestamps <= end + server.overlap)]
+            body = make_raw_response(rows)
+            time.sleep(server.delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        # Requests are counted by the server, not logged
+        pass
+
+
+def start_server(records, overlap=OVERLAP, delay=DELAY, port=0):
+    '''
+    Input: structured array of 10mn rows served, seconds of rows returned after each window,
+           seconds spent on each request, port (a free one if 0)
+    Output: StandinServer running in a background thread, stopped with shutdown()
+    '''
+    server = StandinServer(records, overlap, delay, port)
+    threading.Thread(target=server.serve_forever, name='standin-server', daemon=True).start()
+    return server
+
+
+def check_backfill(days=CHECK_DAYS, max_workers=CHECK_WORKERS, requests_per_second=CHECK_REQUESTS_PER_SECOND):
+    '''
+    Input: number of days collected, maximum number of concurrent requests, maximum number of requests per second
+    Output: list of failed checks, empty if backfill.py behaves as expected
+    '''
+    from backfill import WINDOW, backfill, split_windows
+
+    failures = []
+    records = generate_records(years=1)
+    last_day = pd.Timestamp(int(records['datetime_utc'][-1]), unit='s', tz='UTC').floor('D')
+    begin_date = (last_day - pd.Timedelta(days=days)).to_pydatetime()
+    finish_date = (last_day - timedelta(minutes=1)).to_pydatetime()
+
+    # Windows
+    windows = split_windows(begin_date, finish_date)
+    if len(windows) != days:
+        failures.append(f"{len(windows)} windows for {days} days")
+    if windows[0][0] != begin_date or windows[-1][1] != finish_date:
+        failures.append("windows do not cover the range")
+    for (start, end), (next_start, _) in zip(windows, windows[1:]):
+        if end - start > WINDOW or next_start - end != timedelta(minutes=1):
+            failures.append(f"window {start} - {end} not contiguous with the next one")
+
+    server = start_server(records)
+    try:
+        df = backfill(begin_date, finish_date, url=server.url, max_workers=max_workers,
+                      requests_per_second=requests_per_second)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Concurrency and rate limiting, arrival times being measured by the server
+    if len(server.arrivals) != days:
+        failures.append(f"{len(server.arrivals)} requests received for {days} windows")
+    if not 1 < server.max_in_flight <= max_workers:
+        failures.append(f"{server.max_in_flight} requests served at once with {max_workers} workers")
+    gaps = np.diff(sorted(server.arrivals))
+    # Margin for the time between sending a request and its arrival
+    if len(gaps) and gaps.min() < 0.8 / requests_per_second:
+        failures.append(f"requests {gaps.min():.3f} s apart with {requests_per_second} requests per second")
+
+    # Merge: every served row once, in time order, rows returned after the range by the last window included
+    start_epoch = pd.Timestamp(begin_date).value // 10**9
+    end_epoch = pd.Timestamp(finish_date).value // 10**9 + OVERLAP
+    timestamps = records['datetime_utc']
+    expected = records[(timestamps >= start_epoch) & (timestamps <= end_epoch)]
+    collected = df['datetime_utc'].values.astype('datetime64[s]').astype(np.int64)
+    if not np.array_equal(collected, expected['datetime_utc']):
+        failures.append(f"{len(collected)} rows merged for {len(expected)} rows served, or not in time order")
+    elif not np.allclose(df['demanda'].to_numpy(), expected['demanda'], atol=0.05):
+        failures.append("merged values differ from served values")
+    return failures
+
+
+# Check the backfill engine against the stand-in server
+if __name__ == '__main__':
+    failures = check_backfill()
+    for failure in failures:
+        print("FAILED:", failure)
+    if failures:
+        sys.exit(1)
+    print("Backfill checks passed")
@@ -0,0 +1,288 @@
+# store v0.10
+# Binary columnar storage for REE aggregated data
+#   Updates from v0.9:
+#   - Slice a time range over a list of partitions, as held by snapshots
+
+'''
+REE data aggregated by 10 mn, 1 hour and 1 day is stored as NumPy structured arrays in .npy files, one file per
+duration and per year, in the STORE_PATH directory:
+    STORE_PATH/10mn/2014.npy, STORE_PATH/10mn/2015.npy, ..., STORE_PATH/1d/2024.npy
+Each row holds:
+    - datetime_utc: UTC timestamp as int64 seconds since epoch
+    - demanda, programada, prevista: float64 values
+Files are typed, so no text is parsed when reading them, and they are memory-mapped, so a cold load only maps
+pages from disk instead of building a DataFrame from CSV.
+Rows are sorted by timestamp, so a time range is sliced with 2 binary searches and returned as a view,
+at a cost depending on the size of the range and not on the size of the archive.
+
+Partition files are written to a temporary file then renamed, so a reader never sees a partially written file,
+and a file once written is never modified: snapshots hard-link partition files instead of copying them.
+
+Run 'python3 store.py' once to build the store from the existing REE_data_aggregated_by_*.csv files.
+ingest.py then keeps it up to date along with the CSV files.
+Predictions of the model are stored with the same layout and functions in STORE_PATH/predictions/, using
+PREDICTION_DTYPE, see score.py.
+The application does not read partition files but snapshots of the store, see snapshot.py.
+'''
+
+# Import librairies
+import os
+import numpy as np
+import pandas as pd
+
+# Import constants
+from utils import DATA_PATH, STORE_PATH
+
+# Durations of aggregated data, from the finest to the coarsest, and their length in seconds
+DURATIONS = ['10mn', '1h', '1d']
+STEPS = {'10mn': 600, '1h': 3600, '1d': 86400}
+
+# Minimum number of points wanted in a time range when selecting its aggregation duration
+MIN_POINTS = 500
+
+# Names of value columns
+VALUE_COLUMNS = ['demanda', 'programada', 'prevista']
+
+# Row layout of a partition file
+STORE_DTYPE = np.dtype([('datetime_utc', '<i8')] + [(column, '<f8') for column in VALUE_COLUMNS])
+
+# Row layout of a prediction file and directory of the prediction store within the store
+PREDICTION_DTYPE = np.dtype([('datetime_utc', '<i8'), ('prediction', '<f8')])
+PREDICTION_DIRECTORY = 'predictions'
+
+
+def to_epoch(values):
+    '''
+    Input: array-like of datetime strings or datetime objects in UTC
+    Output: NumPy array of int64 seconds since epoch
+    '''
+    # Dates of the application ('2024-02-19' or '2024-02-19 02:00:00') are parsed by NumPy, without the cost of
+    # building a pandas Series on each request
+    if isinstance(values, (list, tuple)) and all(isinstance(value, str) and len(value) <= 19 for value in values):
+        try:
+            return np.array(values, dtype='datetime64[s]').astype(np.int64)
+        except ValueError:
+            pass
+    datetimes = pd.to_datetime(pd.Series(values), format='ISO8601').values.astype('datetime64[s]')
+    return datetimes.astype(np.int64)
+
+
+def frame_to_records(df):
+    '''
+    Input: dataframe with the UTC timestamp in the 1st column, as found in the aggregated CSV files,
+           and the 3 value columns
+    Output: structured array sorted by timestamp, using STORE_DTYPE
+    '''
+    records = np.empty(len(df), dtype=STORE_DTYPE)
+    records['datetime_utc'] = to_epoch(df.iloc[:, 0])
+    for column in VALUE_COLUMNS:
+        records[column] = df[column].to_numpy(dtype=np.float64)
+    return records[np.argsort(records['datetime_utc'], kind='stable')]
+
+
+def records_to_frame(records):
+    '''
+    Input: structured array using STORE_DTYPE
+    Output: dataframe formatted as the aggregated CSV files, with 'datetime_utc' as a string
+    '''
+    df = pd.DataFrame(records)
+    df['datetime_utc'] = records['datetime_utc'].astype('datetime64[s]').astype(str)
+    df['datetime_utc'] = df['datetime_utc'].str.replace('T', ' ')
+    return df
+
+
+def rollup(records, duration):
+    '''
+    Input: structured array sorted by timestamp, coarser duration to aggregate to
+    Output: structured array with the same layout and one row per step of duration, holding the mean of values
+            within the step
+    '''
+    step = STEPS[duration]
+    buckets, inverse = np.unique(records['datetime_utc'] // step * step, return_inverse=True)
+    rolled_up = np.empty(len(buckets), dtype=records.dtype)
+    rolled_up['datetime_utc'] = buckets
+    for column in records.dtype.names[1:]:
+        values = records[column]
+        valid = ~np.isnan(values)
+        sums = np.bincount(inverse, weights=np.where(valid, values, 0.0), minlength=len(buckets))
+        counts = np.bincount(inverse, weights=valid, minlength=len(buckets))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rolled_up[column] = sums / counts
+    return rolled_up
+
+
+def _years(records):
+    # Calendar year of each row, used to split rows between partition files
+    return records['datetime_utc'].astype('datetime64[s]').astype('datetime64[Y]').astype(np.int64) + 1970
+
+
+def partition_files(duration, path):
+    '''
+    Input: duration of aggregated data, path of the store
+    Output: sorted list of paths of the partition files of the duration, in time order
+    '''
+    directory = os.path.join(path, duration)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.npy')]
+
+
+def save_atomic(file_path, array):
+    '''
+    Input: path of a .npy file, array to save
+    Output: None, the array is written to a temporary file renamed to file_path once complete
+    '''
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        np.save(file, array)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def write_store(records, duration, path=STORE_PATH):
+    '''
+    Input: structured array sorted by timestamp with 'datetime_utc' as first field, duration of aggregated data
+    Output: None, one partition file is written per year found in records
+    '''
+    os.makedirs(os.path.join(path, duration), exist_ok=True)
+    years = _years(records)
+    for year in np.unique(years):
+        save_atomic(os.path.join(path, duration, f'{year}.npy'), records[years == year])
+
+
+def last_timestamp(duration, path=STORE_PATH):
+    '''
+    Input: duration of aggregated data
+    Output: timestamp of the last stored row in seconds since epoch, None if nothing is stored
+    '''
+    files = partition_files(duration, path)
+    for file in reversed(files):
+        partition = np.load(file, mmap_mode='r')
+        if len(partition):
+            return int(partition['datetime_utc'][-1])
+    return None
+
+
+def upsert_store(records, duration, path=STORE_PATH):
+    '''
+    Input: structured array sorted by timestamp with 'datetime_utc' as first field, duration of aggregated data
+    Output: rows written to the store
+
+    Rows are merged with stored rows by timestamp: a row replaces the stored row with the same timestamp, so the
+    last row of a coarse duration computed from partial data gets updated, and rows older than the last stored row
+    fill gaps in time order. Running the same upsert twice leaves the store unchanged.
+    Only the partition files of the years of written rows are rewritten.
+    '''
+    if len(records) == 0:
+        return records
+    years = _years(records)
+    for year in np.unique(years):
+        file_path = os.path.join(path, duration, f'{year}.npy')
+        new_records = records[years == year]
+        if os.path.exists(file_path):
+            stored = np.load(file_path)
+            kept = stored[~np.isin(stored['datetime_utc'], new_records['datetime_utc'])]
+            new_records = np.concatenate([kept, new_records])
+            new_records = new_records[np.argsort(new_records['datetime_utc'], kind='stable')]
+        write_store(new_records, duration, path)
+    return records
+
+
+def load_store(duration, path=STORE_PATH):
+    '''
+    Input: duration of aggregated data
+    Output: read-only structured array holding all stored rows for this duration
+    '''
+    files = partition_files(duration, path)
+    if not files:
+        raise FileNotFoundError(f"No data stored for duration '{duration}' in {path}, run store.py to build the store")
+    partitions = [np.load(file, mmap_mode='r') for file in files]
+    if len(partitions) == 1:
+        return partitions[0]
+    records = np.concatenate(partitions)
+    records.flags.writeable = False
+    return records
+
+
+def slice_range(records, start, end):
+    '''
+    Input: structured array sorted by timestamp, start and end dates (datetime objects or strings in UTC)
+    Output: view of the rows with start <= datetime_utc <= end, no data is copied
+    '''
+    start_epoch, end_epoch = to_epoch([start, end])
+    return slice_epoch(records, start_epoch, end_epoch)
+
+
+def slice_epoch(records, start_epoch, end_epoch):
+    '''
+    Input: structured array sorted by timestamp, start and end in seconds since epoch
+    Output: view of the rows with start_epoch <= datetime_utc <= end_epoch, no data is copied
+    '''
+    timestamps = records['datetime_utc']
+    first = np.searchsorted(timestamps, start_epoch, side='left')
+    last = np.searchsorted(timestamps, end_epoch, side='right')
+    return records[first:last]
+
+
+def slice_partitions(partitions, start_epoch, end_epoch):
+    '''
+    Input: non-empty list of structured arrays sorted by timestamp, in time order (e.g. the partitions of a
+           snapshot), start and end in seconds since epoch
+    Output: rows with start_epoch <= datetime_utc <= end_epoch, as a view when they lie in a single partition
+    '''
+    # Partitions overlapping the range only
+    chunks = [
+        slice_epoch(partition, start_epoch, end_epoch) for partition in partitions
+        if len(partition) and partition['datetime_utc'][0] <= end_epoch
+        and partition['datetime_utc'][-1] >= start_epoch
+    ]
+    if not chunks:
+        return partitions[0][:0]
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+def pick_duration(start, end, min_points=MIN_POINTS):
+    '''
+    Input: start and end dates (datetime objects or strings in UTC), minimum number of points wanted
+    Output: coarsest duration giving at least min_points points over the time range,
+            or the finest duration if none does
+    '''
+    start_epoch, end_epoch = to_epoch([start, end])
+    for duration in reversed(DURATIONS):
+        if (end_epoch - start_epoch) // STEPS[duration] >= min_points:
+            return duration
+    return DURATIONS[0]
+
+
+def read_range(duration, start, end, path=STORE_PATH, dtype=STORE_DTYPE):
+    '''
+    Input: duration of aggregated data, start and end dates (datetime objects or strings in UTC),
+           row layout of the stored files
+    Output: structured array holding the rows with start <= datetime_utc <= end,
+            read from the partition files of the corresponding years only
+    '''
+    first_year, last_year = pd.Timestamp(start).year, pd.Timestamp(end).year
+    chunks = []
+    for file in partition_files(duration, path):
+        year = int(os.path.basename(file)[:-4])
+        if first_year <= year <= last_year:
+            chunks.append(slice_range(np.load(file, mmap_mode='r'), start, end))
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+# Build the store from the aggregated CSV files
+if __name__ == '__main__':
+    for duration in DURATIONS:
+        file_path = f'{DATA_PATH}REE_data_aggregated_by_{duration}.csv'
+        print(f"Converting {file_path}...")
+        records = frame_to_records(pd.read_csv(file_path, delimiter=','))
+        write_store(records, duration)
+        print(f"{len(records)} rows stored for duration {duration}")
+
+    from snapshot import publish_snapshot
+    print("Snapshot published:", publish_snapshot())
@@ -0,0 +1,123 @@
+# tiles v0.4
+# Multi-resolution tile pyramid over the binary store
+#   Updates from v0.3:
+#   - Return empty traces for a window covering no tile
+
+'''
+The pyramid has LEVELS levels of fixed-size time tiles aligned on epoch:
+    tile k of level l covers [k * span, (k + 1) * span[ with span = TILE_POINTS * 600 s * LEVEL_RATIO ** l
+so a tile covers about 3.5 days at level 0, 2 weeks at level 1, ... and 10 years at level 5.
+Each level reads the coarsest aggregation duration (10mn, 1h, 1d) still giving at least TILE_POINTS rows per tile,
+and a tile payload holds the traces of the figure (x in seconds since epoch and y values) reduced by LTTB to at
+most TILE_POINTS points: level 0 holds 10mn data unreduced, other levels are reduced up to about 10 times.
+
+A visible window is served at the finest level where at most MAX_TILES tiles cover it, so a zoom or pan never
+ships more than MAX_TILES * TILE_POINTS points per trace, whatever the length of the window.
+Tile payloads are built on first use and kept in a cache keyed by (level, tile, data version), so later windows
+covering the same tiles only concatenate cached arrays.
+'''
+
+# Import librairies
+import numpy as np
+
+# Import functions and constants
+from store import DURATIONS, STEPS, slice_partitions, to_epoch
+from visualize import TRACES, lttb_indices
+
+# Maximum number of points of a trace in a tile
+TILE_POINTS = 512
+
+# Number of levels and ratio between the spans of tiles of 2 consecutive levels
+LEVELS = 6
+LEVEL_RATIO = 4
+
+# Maximum number of tiles covering a visible window
+MAX_TILES = 4
+
+
+def tile_span(level):
+    '''
+    Input: level of the pyramid
+    Output: time covered by a tile, in seconds
+    '''
+    return TILE_POINTS * STEPS[DURATIONS[0]] * LEVEL_RATIO ** level
+
+
+def level_duration(level):
+    '''
+    Input: level of the pyramid
+    Output: coarsest aggregation duration giving at least TILE_POINTS rows per tile of the level
+    '''
+    step = tile_span(level) // TILE_POINTS
+    return [duration for duration in DURATIONS if STEPS[duration] <= step][-1]
+
+
+def tiles_for_window(start_epoch, end_epoch, level):
+    '''
+    Input: start and end of a window in seconds since epoch, level of the pyramid
+    Output: range of the numbers of the tiles covering the window
+    '''
+    span = tile_span(level)
+    return range(start_epoch // span, end_epoch // span + 1)
+
+
+def pick_level(start_epoch, end_epoch):
+    '''
+    Input: start and end of a window in seconds since epoch
+    Output: finest level where at most MAX_TILES tiles cover the window, the coarsest level otherwise
+    '''
+    for level in range(LEVELS):
+        if len(tiles_for_window(start_epoch, end_epoch, level)) <= MAX_TILES:
+            return level
+    return LEVELS - 1
+
+
+def build_tile(data, predictions, level, tile):
+    '''
+    Input: dictionaries of lists of partitions of data and predictions by duration, as loaded from a snapshot,
+           level of the pyramid, tile number
+    Output: list of (x in seconds since epoch, y) arrays of each trace of TRACES, reduced to TILE_POINTS points
+    '''
+    duration = level_duration(level)
+    span = tile_span(level)
+    rows = slice_partitions(data[duration], tile * span, (tile + 1) * span - 1)
+    prediction = slice_partitions(predictions[duration], tile * span, (tile + 1) * span - 1)
+    traces = []
+    for column, _ in TRACES:
+        source = prediction if column == 'prediction' else rows
+        x = np.asarray(source['datetime_utc'], dtype=np.int64)
+        y = np.asarray(source[column], dtype=np.float64)
+        kept = lttb_indices(x, y, TILE_POINTS)
+        traces.append((x[kept], y[kept].astype(np.float32)))
+    return traces
+
+
+def load_window(start, end, data, predictions, cache, version):
+    '''
+    Input: start and end dates of the visible window (datetime objects or strings in UTC),
+           dictionaries of lists of partitions of data and predictions by duration,
+           RangeCache of tile payloads, version of the data
+    Output: level used and list of (x in seconds since epoch, y) arrays of each trace of TRACES within the window,
+            empty if the window covers no tile (end before start)
+    '''
+    start_epoch, end_epoch = (int(epoch) for epoch in to_epoch([start, end]))
+    level = pick_level(start_epoch, end_epoch)
+    tiles = []
+    for tile in tiles_for_window(start_epoch, end_epoch, level):
+        key = (level, tile, version)
+        traces = cache.get(key)
+        if traces is None:
+            traces = build_tile(data, predictions, level, tile)
+            cache.put(key, traces, sum(x.nbytes + y.nbytes for x, y in traces))
+        tiles.append(traces)
+    if not tiles:
+        return level, [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in TRACES]
+
+    # Concatenate tiles trace by trace, and cut the window out of the first and last tiles
+    window = []
+    for index in range(len(TRACES)):
+        x = np.concatenate([traces[index][0] for traces in tiles])
+        y = np.concatenate([traces[index][1] for traces in tiles])
+        first, last = np.searchsorted(x, start_epoch, side='left'), np.searchsorted(x, end_epoch, side='right')
+        window.append((x[first:last], y[first:last]))
+    return level, window
@@ -1,28 +1,51 @@
-# utils v1.3
+# utils v1.10
 # Common functions for processing REE data
-#   Updates from v1.2:
-#   - Add constants for paths and files
+#   Updates from v1.9:
+#   - Document the features expected from the prediction model file
 
 
 # Import librairies
 from datetime import datetime as dt, timedelta
-from dateutil import tz
+import numpy as np
 import pandas as pd
-import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import time
 import warnings
 warnings.filterwarnings('ignore')
 warnings.simplefilter('ignore')
 
+# Decode JSON with orjson when it is installed, much faster on large API responses, or with the json module
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # Define constants
 # Define the URL for the targeted data (electricity demand in real time)
 URL = 'https://apidatos.ree.es/es/datos/demanda/demanda-tiempo-real?'
 APP_PATH = '/var/www/red-wire/'
 DATA_PATH = '/var/www/red-wire/data_db/'
 USER_PATH = '/var/www/red-wire/user_db/'
+STORE_PATH = DATA_PATH + 'store/'
 DATA_REF = 'REE_data_aggregated_by_10mn.csv'
+# Prediction model: pickled scikit-learn estimator fitted either on a DataFrame whose columns are among
+# predict.CALENDAR_FEATURES and predict.DATA_FEATURES, read from its feature_names_in_, or on arrays with the
+# predict.FEATURE_NAMES columns; other models are rejected by predict.load_model
+MODEL_PATH = DATA_PATH + 'Red_Wire_model'
 USER_DB = 'user_connect_db.sqlite'
 
+# Define settings of the HTTP client used for API requests
+# Connect and read timeouts in seconds
+API_TIMEOUT = (10, 60)
+# Number of retries on connection errors and on 429/5xx responses, waiting API_BACKOFF * 2^n seconds before retry n
+API_RETRIES = 5
+API_BACKOFF = 1
+# Number of connections kept alive, at least as many as concurrent requests sent by backfill.py
+API_POOL_SIZE = 8
+
 # Define of a function to convert user defined day and half_day to a datetime object
 def moment(day, half_day):
     '''
@@ -41,6 +64,58 @@ def moment(day, half_day):
         return dt.now().replace(hour=hour, minute=minute, second=0, microsecond=0) - timedelta(days=1)
 
 
+# Define a function creating an HTTP session reusing connections between API requests
+def create_API_session():
+    '''
+    Input: None
+    Output: requests session with a pool of keep-alive connections, retries with exponential backoff
+            on connection errors and 429/5xx responses, and gzip compression
+    '''
+    retries = Retry(
+        total=API_RETRIES,
+        backoff_factor=API_BACKOFF,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=API_POOL_SIZE, pool_maxsize=API_POOL_SIZE, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0',
+        'Accept-Encoding': 'gzip, deflate',
+    })
+    return session
+
+# Session shared by all API requests of a process
+API_session = create_API_session()
+
+# Latencies of API requests in seconds, retries included, shared by the threads of backfill.py
+API_latencies = []
+API_latencies_lock = threading.Lock()
+
+
+# Define a function summarizing latencies of the API requests sent so far
+def API_stats():
+    '''
+    Input: None
+    Output: dictionary with the number of requests and their mean, median, 95th percentile and max latencies
+    '''
+    with API_latencies_lock:
+        latencies = np.array(API_latencies)
+    if len(latencies) == 0:
+        return {'requests': 0}
+    return {
+        'requests': len(latencies),
+        'mean_s': round(float(latencies.mean()), 3),
+        'p50_s': round(float(np.percentile(latencies, 50)), 3),
+        'p95_s': round(float(np.percentile(latencies, 95)), 3),
+        'max_s': round(float(latencies.max()), 3),
+    }
+
+
 # Define a function building an API request based on user defined start and end dates
 def API_request(url, start, end):
 
@@ -50,23 +125,18 @@ def API_request(url, start, end):
         "end_date"   : end,
         "time_trunc" : "hour",
     }
-    
-    # Set user agent
-    user_agent = ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0')
-
-    # Set request headers
-    headers = {
-        "User-Agent": user_agent,
-        # "Accept": "application/json",
-    }
+
 
     # Display start and end date and time to be used by the API request
     print("\nStart date for API request :", start)
     print("End date for API request   :", end)
     print("Please wait while data is being downloaded...")
 
-    # Send GET request and collect returned data into 'response'
-    response = requests.get(url=url, params=request_params, headers=headers)
+    # Send GET request through the shared session and collect returned data into 'response'
+    request_time = time.perf_counter()
+    response = API_session.get(url=url, params=request_params, timeout=API_TIMEOUT)
+    with API_latencies_lock:
+        API_latencies.append(time.perf_counter() - request_time)
 
     # Display response code and url returned by the API
     print("API request completed.")
@@ -77,49 +147,108 @@ def API_request(url, start, end):
     return response
 
 
+# Define a function decoding the body of an API response into raw data
+def decode_API_response(content):
+    '''
+    Input: body of an API response holding real, planned and forecast demand, as bytes
+    Output: dataframe with 'datetime' in REE format, 'datetime_utc' as naive UTC datetimes
+            and 'demanda', 'programada', 'prevista' as float values (NaN when missing)
+    '''
+    # Parse JSON once
+    demanda_real, demanda_programada, demanda_prevista = (
+        item['attributes']['values'] for item in json_loads(content)['included'][:3]
+    )
+    # Keep rows for which the 3 values are available, as when zipping the 3 lists
+    rows = min(len(demanda_real), len(demanda_programada), len(demanda_prevista))
+    df = pd.DataFrame({
+        'datetime': [real['datetime'] for real in demanda_real[:rows]],
+        'demanda': np.array([real['value'] for real in demanda_real[:rows]], dtype=np.float64),
+        'programada': np.array([programada['value'] for programada in demanda_programada[:rows]], dtype=np.float64),
+        'prevista': np.array([prevista['value'] for prevista in demanda_prevista[:rows]], dtype=np.float64),
+    })
+    # Convert all timestamps at once
+    df['datetime_utc'] = ree_datetimes_to_utc(df['datetime'])
+    return df
+
+
+# Define a function extracting raw data from an API response
+def API_response_to_df(response):
+    '''
+    Input: API response holding real, planned and forecast demand
+    Output: dataframe of raw data, see decode_API_response
+    '''
+    return decode_API_response(response.content)
+
+
 # Define a function to convert REE datetime to UTC special format
 def datetime_to_utc_str(date):
     '''
-    Input: date string in REE format
-    Output: date string in UTC format
+    Input: date string in REE format, or series of date strings
+    Output: date string in UTC format, or series of date strings
 
     Example:
     REE datetime format: "2024-02-19T03:00:00.000+01:00", string length: 29
-    Target UTC datetime format: "2024-02-18 23:00:00", string length: 19
+    Target UTC datetime format: "2024-02-19 02:00:00", string length: 19
     '''
-    date_time = dt.strptime(date, '%Y-%m-%dT%H:%M:%S.%f%z')
-    datetime_utc = date_time.astimezone(pytz.UTC)
-    datetime_utc = datetime_utc.strftime("%Y-%m-%d %H:%M:%S")
+    datetime_utc = ree_datetimes_to_utc(date).dt.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(date, str):
+        return datetime_utc[0]
     return datetime_utc
 
 
+# Define a function to convert a series of REE datetimes to UTC
+def ree_datetimes_to_utc(datetimes):
+    '''
+    Input: series of date strings in REE format
+    Output: series of naive datetimes in UTC
+
+    Example:
+    REE datetime format: "2024-02-19T03:00:00.000+01:00"
+    Target UTC datetime: 2024-02-19 02:00:00
+
+    Local times and UTC offsets are parsed separately, as parsing strings holding an offset is much slower
+    and REE data only holds a couple of distinct offsets (CET and CEST).
+    '''
+    datetimes = pd.Series(datetimes)
+    local_datetimes = pd.to_datetime(datetimes.str[:-6], format="%Y-%m-%dT%H:%M:%S.%f")
+    offsets = datetimes.str[-6:]
+    offset_minutes = {
+        offset: (-1 if offset[0] == '-' else 1) * (int(offset[1:3]) * 60 + int(offset[4:6]))
+        for offset in offsets.unique()
+    }
+    return local_datetimes - pd.to_timedelta(offsets.map(offset_minutes), unit='min')
+
+
 # Define a function to convert REE datetime to UTC special format and aggregate values by duration
 def aggreg_to_utc_duration(df, duration):
     '''
     Input: dataframe with datetime in REE format
     Output: dataframe with datetime in special UTC format and values aggregated by duration
     '''
+    # Frequency used to truncate UTC timestamps to the specified duration
     durations = {
-        "10mn": 15,
-        "1h": 13,
-        "1d": 10
+        "10mn": "10min",
+        "1h": "h",
+        "1d": "D"
     }
-    # Set the time string to complete the truncated timestamp to the duration format
-    time_string = " 00:00:00"
 
-    # Change string to/from datetime object to convert the timestamp to UTC
-    df['datetime'] = pd.to_datetime(df['datetime'], format="%Y-%m-%dT%H:%M:%S.%f%z")
-    df['datetime'] = df['datetime'].apply(lambda x: x.tz_convert(tz.tzutc()))
-    df['datetime'] = df['datetime'].dt.strftime("%Y-%m-%d %H:%M:%S")
-    # Truncate the timestamp to the specified duration and store it as a new column 'datatime_UTC'
-    df['datetime_UTC']=df['datetime'].str[:durations[duration]]
+    # Convert all timestamps to UTC at once, whatever their offset (CET or CEST), unless already done,
+    # and truncate them to the specified duration
+    if 'datetime_utc' in df:
+        datetime_utc = df['datetime_utc']
+    else:
+        datetime_utc = ree_datetimes_to_utc(df['datetime'])
+    datetime_utc = datetime_utc.dt.floor(durations[duration])
 
     # Create a dataframe with UTC timestamps where a data value is the mean of values for the specified duration
-    df_duration = df.groupby('datetime_UTC')['demanda'].mean().reset_index()
-    df_duration['programada'] = df.groupby('datetime_UTC')['prevista'].mean().reset_index()['prevista']
-    df_duration['prevista'] = df.groupby('datetime_UTC')['prevista'].mean().reset_index()['prevista']
+    df_duration = (
+        df[['demanda', 'programada', 'prevista']]
+        .groupby(datetime_utc.rename('datetime_UTC'))
+        .mean()
+        .reset_index()
+    )
+
+    # Format timestamps as in the aggregated data files
+    df_duration['datetime_UTC'] = df_duration['datetime_UTC'].dt.strftime("%Y-%m-%d %H:%M:%S")
 
-    # Complete the truncated timestamp according to the specified duration
-    df_duration['datetime_UTC'] += time_string[durations[duration]-19:]
-    
     return df_duration
\ No newline at end of file
@@ -1,30 +1,205 @@
-# visualize v0.3:
-#   Edit first axis title to mention the MW unit
-#   Remove second and third axis titles
+# visualize v0.10:
+#   Measure the serialized size of partial updates without serializing them
 
+import base64
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
+from dash import Patch
+
+# Maximum number of points per trace sent to the browser
+MAX_POINTS = 2000
+
+# Bytes of an operation of a partial update serialized to JSON, besides its value: operation name, location, keys
+OPERATION_BYTES = 80
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    Input: x and y values as NumPy arrays, x sorted, target number of points
+    Output: indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+
+    First and last points are always kept. Interior points are split into n_out-2 buckets and the point kept in
+    each bucket forms the largest triangle with the averages of the previous and next buckets, which keeps the
+    peaks and troughs of the series. All buckets are processed at once with NumPy.
+    '''
+    n = len(x)
+    if n_out is None or n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Bucket boundaries over interior points 1 to n-2
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, counts = edges[:-1], np.diff(edges)
+    bucket = np.repeat(np.arange(n_out - 2), counts)
+    x_in, y_in = x[1:n - 1], y[1:n - 1]
+
+    # Average point of each bucket, ignoring missing values
+    valid = ~np.isnan(y_in)
+    valid_counts = np.maximum(np.add.reduceat(valid, starts - 1), 1)
+    mean_x = np.add.reduceat(x_in, starts - 1) / counts
+    mean_y = np.add.reduceat(np.where(valid, y_in, 0.0), starts - 1) / valid_counts
+
+    # Previous and next anchors of each bucket: neighbour bucket averages, or first and last points at the ends
+    prev_x, prev_y = np.concatenate([[x[0]], mean_x[:-1]]), np.concatenate([[y[0]], mean_y[:-1]])
+    next_x, next_y = np.concatenate([mean_x[1:], [x[-1]]]), np.concatenate([mean_y[1:], [y[-1]]])
+
+    # Doubled area of the triangle formed by each point and the anchors of its bucket
+    ax, ay, cx, cy = prev_x[bucket], prev_y[bucket], next_x[bucket], next_y[bucket]
+    area = np.abs((ax - cx) * (y_in - ay) - (ax - x_in) * (cy - ay))
+    area = np.nan_to_num(area, nan=-1.0)
+
+    # First point reaching the largest area in each bucket
+    largest = np.maximum.reduceat(area, starts - 1)
+    candidates = np.flatnonzero(area == largest[bucket])
+    _, first = np.unique(bucket[candidates], return_index=True)
+    return np.concatenate([[0], candidates[first] + 1, [n - 1]])
+
+
+# Names and y-axes of traces, in the order of the figure data
+# All traces are always present, possibly empty, so that partial updates address them by index
+TRACES = [
+    ('demanda', dict(name='Consommation')),
+    ('programada', dict(name='Planification', yaxis='y2')),
+    ('prevista', dict(name='Prédiction', yaxis='y3')),
+    ('prediction', dict(name='Prédiction Red Wire')),
+]
+
+
+def typed_array(values, dtype):
+    '''
+    Input: array of values, dtype of a Plotly typed array ('f4', 'f8', 'i4'...)
+    Output: dictionary encoding the values as a Plotly typed array: base64 of their little-endian bytes
+
+    Typed arrays are decoded by plotly.js without parsing numbers, and take less space than JSON numbers.
+    '''
+    array = np.ascontiguousarray(values, dtype='<' + dtype)
+    return {'dtype': dtype, 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def make_trace_data(figure_df, max_points=MAX_POINTS, prediction=None):
+    '''
+    Input: data with 'datetime_utc', 'demanda', 'programada' and 'prevista' columns, maximum number of points per
+           trace (None to keep all points), data with 'datetime_utc' and 'prediction' columns (None if no prediction)
+    Output: list of dictionaries with x and y typed arrays of each trace of TRACES, x in milliseconds since epoch
+    '''
+    trace_data = []
+    for column, _ in TRACES:
+        source = prediction if column == 'prediction' else figure_df
+        if source is None or len(source) == 0:
+            x_numeric, y = np.empty(0, dtype=np.int64), np.empty(0)
+        else:
+            # Timestamps as seconds since epoch, whether stored as integers, strings or datetimes
+            x_numeric = np.asarray(source['datetime_utc']).astype('datetime64[s]').astype(np.int64)
+            y = np.asarray(source[column], dtype=np.float64)
+        # Downsample each trace separately to keep its own peaks and troughs
+        kept = lttb_indices(x_numeric, y, max_points)
+        trace_data.append(encode_trace(x_numeric[kept], y[kept]))
+    return trace_data
+
+
+def encode_trace(x_seconds, y):
+    '''
+    Input: x values in seconds since epoch, y values
+    Output: dictionary with x and y typed arrays of a trace
+    '''
+    # Dates as milliseconds since epoch, read as UTC dates by a date axis; values in MW fit in float32
+    return {'x': typed_array(x_seconds * 1000, 'f8'), 'y': typed_array(y, 'f4')}
+
+
+def make_figure_layout(uirevision=None):
+    '''
+    Input: revision of the user interface state, zoom and pan being kept while it does not change
+    Output: layout with 3 y-axes corresponding to the 3 value columns and a date x-axis
+    '''
+    return {
+        'yaxis': {'title': {'text': 'Consommation en MW'}},
+        'yaxis2': {'overlaying': 'y', 'side': 'right'},
+        'yaxis3': {'overlaying': 'y', 'side': 'right'},
+        'xaxis': {'title': {'text': 'Date'}, 'type': 'date'},
+        'uirevision': uirevision,
+        #'title': 'Comparaison des valeurs de consommation, planification et prédiction',
+    }
+
+
+def make_figure_payload(figure_df, max_points=MAX_POINTS, prediction=None, uirevision=None):
+    '''
+    Args:
+        figure_df: data with 'datetime_utc', 'demanda', 'programada' and 'prevista' columns
+        max_points: maximum number of points per trace, None to keep all points
+        prediction: data with 'datetime_utc' and 'prediction' columns, empty trace if None
+        uirevision: revision of the user interface state
+
+    Returns:
+        dict: figure ready to be sent to the browser, built without Plotly validators
+    '''
+    trace_data = make_trace_data(figure_df, max_points, prediction)
+    data = [
+        {'type': 'scatter', 'mode': 'lines', **trace_args, **xy}
+        for (_, trace_args), xy in zip(TRACES, trace_data)
+    ]
+    return {'data': data, 'layout': make_figure_layout(uirevision)}
+
+
+def make_figure_patch(figure_df, max_points=MAX_POINTS, prediction=None, uirevision=None):
+    '''
+    Args:
+        figure_df, max_points, prediction: see make_figure_payload
+        uirevision: revision of the user interface state, unchanged if None
+
+    Returns:
+        Patch: partial update of a figure built by make_figure_payload, replacing x and y of its traces only
+    '''
+    return make_traces_patch(make_trace_data(figure_df, max_points, prediction), uirevision)
+
+
+def make_traces_patch(trace_data, uirevision=None):
+    '''
+    Args:
+        trace_data: list of dictionaries with x and y typed arrays of each trace of TRACES
+        uirevision: revision of the user interface state, unchanged if None
+
+    Returns:
+        Patch: partial update of a figure built by make_figure_payload, replacing x and y of its traces only
+    '''
+    patch = Patch()
+    for index, xy in enumerate(trace_data):
+        patch['data'][index]['x'] = xy['x']
+        patch['data'][index]['y'] = xy['y']
+    if uirevision is not None:
+        patch['layout']['uirevision'] = uirevision
+    return patch
+
+
+def patch_bytes(patch):
+    '''
+    Input: Patch built by make_traces_patch
+    Output: size of the Patch serialized to JSON in bytes, mostly the base64 strings of its typed arrays, measured
+            without serializing it
+    '''
+    size = 0
+    for operation in patch.to_plotly_json()['operations']:
+        value = operation['params'].get('value')
+        if isinstance(value, dict) and 'bdata' in value:
+            # Plotly escapes '/' as '\u002f' in JSON
+            size += len(value['bdata']) + 5 * value['bdata'].count('/') + len(value['dtype'])
+        else:
+            size += len(str(value))
+        size += OPERATION_BYTES
+    return size
+
 
 # Plot a bar graph to compare observed value and prediction
-def make_figure_from_prediction(figure_df):
-
-    # Create a new Figure
-    fig = go.Figure()
-
-    # Add a line for each value column
-    fig.add_trace(go.Scatter(x=figure_df['datetime_utc'], y=figure_df['demanda'], mode='lines', name='Consommation'))
-    fig.add_trace(go.Scatter(x=figure_df['datetime_utc'], y=figure_df['programada'], mode='lines', name='Planification', yaxis='y2'))
-    fig.add_trace(go.Scatter(x=figure_df['datetime_utc'], y=figure_df['prevista'], mode='lines', name='Prédiction', yaxis='y3'))
-
-    # Create layout with 3 y-axes corresponding to the 3 value columns
-    fig.update_layout(
-        yaxis=dict(title='Consommation en MW'),
-        yaxis2=dict(overlaying='y', side='right'),
-        yaxis3=dict(overlaying='y', side='right'),
-        xaxis=dict(title='Date'),
-        #title='Comparaison des valeurs de consommation, planification et prédiction',
-    )
-
-    return fig
+def make_figure_from_prediction(figure_df, max_points=MAX_POINTS, prediction=None):
+    '''
+    Args:
+        figure_df: data with 'datetime_utc', 'demanda', 'programada' and 'prevista' columns
+        max_points: maximum number of points per trace, None to keep all points
+        prediction: data with 'datetime_utc' and 'prediction' columns, empty trace if None
+
+    Returns:
+        go.Figure: one line per value column
+    '''
+    return go.Figure(make_figure_payload(figure_df, max_points, prediction))